@@ -0,0 +1,11 @@
+"""
+Benchmarks for the core operations of datasets.py, run on synthetic data of
+realistic shapes across a ladder of sizes. Run with
+
+    python -m benchmarks --output results.json
+    python -m benchmarks --baseline results.json
+
+from the repository root. See python -m benchmarks --help for the options.
+"""
+
+from .runner import run, compare, save_results, load_results, print_table
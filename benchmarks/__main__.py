@@ -0,0 +1,36 @@
+import argparse
+import sys
+
+from . import synthetic
+from .cases import cases
+from .runner import run, compare, save_results, load_results, print_table
+
+
+parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                 description="Benchmark the core operations of datasets.py.")
+parser.add_argument('--kinds', nargs='+', choices=list(synthetic.sizes), help="kinds of data (default: all)")
+parser.add_argument('--sizes', nargs='+', choices=['small', 'medium', 'large'],
+                    help="sizes of data (default: small medium)")
+parser.add_argument('--cases', nargs='+', choices=list(cases), help="operations (default: all)")
+parser.add_argument('--repeat', type=int, default=5, help="timing repeats (default: 5)")
+parser.add_argument('--min-time', type=float, default=0.05,
+                    help="minimum time per repeat in seconds (default: 0.05)")
+parser.add_argument('--output', help="save the results to this JSON file")
+parser.add_argument('--baseline', help="compare against results saved with --output")
+parser.add_argument('--tolerance', type=float, default=0.25,
+                    help="slowdown counted as a regression (default: 0.25, so 25%%)")
+args = parser.parse_args()
+
+baseline = load_results(args.baseline) if args.baseline else None
+results = run(args.kinds, args.sizes, args.cases, args.repeat, args.min_time)
+print_table(results, baseline)
+if args.output:
+    save_results(results, args.output)
+
+if baseline:
+    regressions = compare(results, baseline, args.tolerance)
+    for result, ratio in regressions:
+        print("Regression: {} on {} {} is {:.2f}x slower".format(
+            result['case'], result['kind'], result['size'], ratio))
+    if regressions:
+        sys.exit(1)
@@ -0,0 +1,76 @@
+"""
+The operations being benchmarked. Each case takes a dataset and a temporary
+folder, does any setup, and returns the function to be timed.
+"""
+
+import os
+import numpy as np
+import datasets as ds
+
+
+def take(data, folder):
+    i = {data.axes[0]: len(data.axis(data.axes[0])) // 2}
+    return lambda: data.take(**i)
+
+
+def take_raw(data, folder):
+    i = {data.axes[0]: len(data.axis(data.axes[0])) // 2}
+    return lambda: data.take_raw(**i)
+
+
+def take_raw_multi(data, folder):
+    # Indexing every axis but the last, like a viewer picking a single spectrum
+    i = {key: len(data.axis(key)) // 2 for key in data.axes[:-1]}
+    return lambda: data.take_raw(**i)
+
+
+def take_sum(data, folder):
+    def func():
+        # Reductions are cached, so forget them to time the actual sum
+        data.clear_cache()
+        return data.take_sum('wl')
+    return func
+
+
+def join(data, folder):
+    return lambda: data.join(data, data.axes[0])
+
+
+def expand(data, folder):
+    return lambda: data.expand('run', 0)
+
+
+def astype(data, folder):
+    return lambda: data.astype(np.float32)
+
+
+def _save_case(**kwargs):
+    def case(data, folder):
+        filename = os.path.join(folder, 'save.ds')
+        return lambda: data.save(filename, **kwargs)
+    return case
+
+
+def _load_case(**kwargs):
+    def case(data, folder):
+        filename = os.path.join(folder, 'load.ds')
+        data.save(filename, **kwargs)
+        return lambda: ds.load(filename)
+    return case
+
+
+cases = {
+    'take': take,
+    'take_raw': take_raw,
+    'take_raw_multi': take_raw_multi,
+    'take_sum': take_sum,
+    'join': join,
+    'expand': expand,
+    'astype': astype,
+    'save': _save_case(),
+    'save_native': _save_case(format='native'),
+    'save_native_zlib': _save_case(format='native', codec='zlib', compress=1),
+    'load': _load_case(),
+    'load_native': _load_case(format='native'),
+    'load_native_zlib': _load_case(format='native', codec='zlib', compress=1),
+}
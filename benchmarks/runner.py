@@ -0,0 +1,143 @@
+"""
+Timing, memory profiling and baseline comparison.
+"""
+
+import gc
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from . import synthetic
+from .cases import cases as all_cases
+
+
+def time_func(func, repeat=5, min_time=0.05):
+    """
+    Time func, calling it enough times per repeat to take at least min_time.
+    Returns the per-call times of each repeat.
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    times = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return times
+
+
+def peak_memory(func):
+    """Peak bytes allocated by one call of func. numpy reports to tracemalloc too."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(kinds=None, sizes=None, cases=None, repeat=5, min_time=0.05, progress=None):
+    """
+    Run the benchmarks, returning a list of result dicts. kinds, sizes and cases
+    are lists of names to run (everything by default, except the 'large' sizes).
+    """
+    kinds = kinds or list(synthetic.sizes)
+    sizes = sizes or ['small', 'medium']
+    cases = cases or list(all_cases)
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for kind in kinds:
+            for size in sizes:
+                data = synthetic.make(kind, size)
+                for name in cases:
+                    func = all_cases[name](data, folder)
+                    func()
+                    times = time_func(func, repeat, min_time)
+                    result = {
+                        'case': name,
+                        'kind': kind,
+                        'size': size,
+                        'shape': list(data.raw.shape),
+                        'nbytes': int(data.raw.nbytes),
+                        'time_min': min(times),
+                        'time_median': float(np.median(times)),
+                        'peak_bytes': peak_memory(func),
+                    }
+                    results.append(result)
+                    if progress:
+                        progress(result)
+    return results
+
+
+def _key(result):
+    return result['case'], result['kind'], result['size']
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Compare results against baseline results, returning a list of (result, ratio)
+    for the ones slower than the baseline by more than 'tolerance' (0.25 is 25%).
+    The minimum times are compared, as they're the least noisy.
+    """
+    previous = {_key(x): x for x in baseline}
+    regressions = []
+    for result in results:
+        if _key(result) in previous:
+            ratio = result['time_min'] / previous[_key(result)]['time_min']
+            if ratio > 1 + tolerance:
+                regressions.append((result, ratio))
+    return regressions
+
+
+def save_results(results, filename):
+    info = {
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    with open(filename, 'w') as f:
+        json.dump({'info': info, 'results': results}, f, indent=1)
+
+
+def load_results(filename):
+    with open(filename) as f:
+        return json.load(f)['results']
+
+
+def _format_time(t):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if t >= scale:
+            return "{:.3g}{}".format(t / scale, unit)
+    return "{:.3g}ns".format(t / 1e-9)
+
+
+def format_row(result, baseline=None):
+    row = "{:<18} {:<14} {:<7} {:>10} {:>10} {:>10}".format(
+        result['case'], result['kind'], result['size'], _format_time(result['time_min']),
+        _format_time(result['time_median']), "{:.3g}MB".format(result['peak_bytes'] / 1e6))
+    if baseline is not None and _key(result) in baseline:
+        row += " {:>7.2f}x".format(result['time_min'] / baseline[_key(result)]['time_min'])
+    return row
+
+
+def print_table(results, baseline=None):
+    baseline = {_key(x): x for x in baseline} if baseline else None
+    print("{:<18} {:<14} {:<7} {:>10} {:>10} {:>10}{}".format(
+        'case', 'kind', 'size', 'min', 'median', 'peak mem', ' vs base' if baseline else ''))
+    for result in results:
+        print(format_row(result, baseline))
@@ -0,0 +1,72 @@
+"""
+Synthetic data shaped like the real thing: power sweeps (power x wl),
+hyperspectral scans (pos x y x wl) and grids of power sweeps (x x y x power x wl),
+so both the size of the data and the number of axes can be scaled.
+"""
+
+import numpy as np
+import datasets as ds
+
+# Shapes for each kind of data, from a quick check to bigger than a typical scan
+sizes = {
+    'power_sweep': {
+        'small': (20, 1340),
+        'medium': (200, 1340),
+        'large': (2000, 1340),
+    },
+    'hyperspectral': {
+        'small': (10, 10, 1340),
+        'medium': (40, 40, 1340),
+        'large': (100, 100, 1340),
+    },
+    'sweep_grid': {
+        'small': (3, 3, 20, 1340),
+        'medium': (10, 10, 20, 1340),
+        'large': (20, 20, 100, 1340),
+    },
+}
+
+
+def _spectra(shape, rng):
+    # Noisy counts on a background, with a few sharp peaks so the data is
+    # about as compressible as real spectra
+    wl = np.arange(shape[-1])
+    peaks = rng.uniform(0, shape[-1], 5)
+    line = 600 + sum(2000*np.exp(-(wl-p)**2/8) for p in peaks)
+    return (line + rng.normal(0, 20, shape)).astype(np.float64)
+
+
+def power_sweep(n_power, n_wl, seed=0):
+    rng = np.random.default_rng(seed)
+    data = ds.dataset(_spectra((n_power, n_wl), rng),
+                      power=np.linspace(0, 100, n_power), wl=np.linspace(850, 950, n_wl))
+    data.metadata['background'] = rng.normal(600, 5, n_wl)
+    return data
+
+
+def hyperspectral(n_pos, n_y, n_wl, seed=0):
+    rng = np.random.default_rng(seed)
+    data = ds.dataset(_spectra((n_pos, n_y, n_wl), rng),
+                      pos=np.arange(n_pos), y=np.arange(n_y), wl=np.linspace(850, 950, n_wl))
+    data.metadata['background'] = rng.normal(600, 5, n_wl)
+    return data
+
+
+def sweep_grid(n_x, n_y, n_power, n_wl, seed=0):
+    rng = np.random.default_rng(seed)
+    data = ds.dataset(_spectra((n_x, n_y, n_power, n_wl), rng), x=np.arange(n_x), y=np.arange(n_y),
+                      power=np.linspace(0, 100, n_power), wl=np.linspace(850, 950, n_wl))
+    data.metadata['background'] = rng.normal(600, 5, n_wl)
+    return data
+
+
+generators = {
+    'power_sweep': power_sweep,
+    'hyperspectral': hyperspectral,
+    'sweep_grid': sweep_grid,
+}
+
+
+def make(kind, size):
+    """Make a dataset of the given kind (a key of 'sizes') and size."""
+    return generators[kind](*sizes[kind][size])
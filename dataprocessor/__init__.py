@@ -1,23 +1,405 @@
+import copy
+import functools
+import pickle
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+from .profiling import PipelineProfile
+from .batch import Batch
+from .cache import ResultCache, fingerprint, cache_policies
+from .journal import RunJournal
+
+
+executors = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+
+
+def _run_branch(processor, i, item):
+    # Calls to make in the parent, see run_in_parent
+    calls = []
+    for p in processor.processors():
+        p._parent_calls = calls
+    result = processor.branch(i, item)
+    # Only the keys written by the branch are in the first map of its storage
+    written = processor.storage.maps[0]
+    written = {key: written[key] for key in processor.downstream_outputs() if key in written}
+    # Timings recorded in another process need to be sent back
+    profile = processor.profile
+    timings = (profile.stats, profile.events) if profile is not None and profile._copied else None
+    return result, written, timings, calls
+
+
+def _picklable(storage):
+    # The values in storage that can be sent to another process, leaving out things
+    # like database connections and figures
+    kept = {}
+    for key, value in storage.items():
+        try:
+            pickle.dumps(value)
+        except Exception:
+            continue
+        kept[key] = value
+    return kept
+
+
+def _resumable(run):
+    # Lets run take resume=True whichever processor is first in the chain, see set_journal
+    @functools.wraps(run)
+    def wrapper(self, dataset, *args, resume=None, **kwargs):
+        if resume is not None:
+            for processor in self.processors():
+                processor.resume = resume
+        return run(self, dataset, *args, **kwargs)
+    wrapper._resumable = True
+    return wrapper
+
+
+def _cached_run(processor, dataset):
+    processor.cache.run(processor, dataset)
+
+
+def _batch_run(processor, args):
+    return type(processor).run_batch(processor, *args)
+
+
 class DataProcessor:
+    # Storage keys this processor reads
+    inputs = ()
+    # Storage keys this processor writes, which are merged back from parallel branches
+    outputs = ()
+    # Storage keys holding objects this processor changes in place (rather than
+    # replacing them), which every parallel branch gets its own copy of
+    mutates = ()
+    # Whether run can call run_next more than once for a dataset, like once per peak
+    fans_out = False
+    # Whether results can be cached, see set_cache. Only for processors that call
+    # run_next at most once, after writing their outputs
+    cached = False
+    # Inputs that don't change the cached results, like plotting options
+    cache_ignore = ()
+    cache = None
+    cache_policy = 'use'
+    # How iterating processors run their branches - None (one by one), 'thread' or 'process'
+    executor = None
+    workers = None
+    # The PipelineProfile recording timings, see set_profiling
+    profile = None
+    # Processors can define run_batch(batch, storages) to handle many datasets at
+    # once, see run_batched
+    run_batch = None
+    # The RunJournal recording finished work, and whether to skip it, see set_journal
+    journal = None
+    resume = False
+    # Where run_in_parent sends calls in a parallel branch
+    _parent_calls = None
+
     def __init__(self, pipeline=None, storage=None):
         if pipeline is None:
             self.pipeline = []
         else:
             self.pipeline = pipeline
-        
+
         if storage is None:
             self.storage = {}
         else:
             self.storage = storage
-            
+
         if len(self.pipeline):
             self.next_processor = self.pipeline[0](self.pipeline[1:], self.storage)
         else:
             self.next_processor = None
-    
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        run = cls.__dict__.get('run')
+        if run is not None and not getattr(run, '_resumable', False):
+            cls.run = _resumable(run)
+
+    @_resumable
     def run(self, dataset):
+        if self._timed(DataProcessor.run, dataset):
+            return
         self.run_next(dataset)
-        
+
+    def _timed(self, run, dataset):
+        # The first processor is run directly rather than by run_next, so when profiling,
+        # its run calls this to time itself. Returns True if it was run here.
+        if self.profile is None or self.profile.running():
+            return False
+        self.profile.call(self, run, dataset)
+        return True
+
     def run_next(self, dataset):
+        processor = self.next_processor
+        if processor is None:
+            return
+        if self.profile is None and self.cache is None:
+            processor.run(dataset)
+            return
+        if processor.cached and processor.cache is not None and processor.cache_policy != 'off':
+            run = _cached_run
+        else:
+            run = type(processor).run
+        if self.profile is None:
+            run(processor, dataset)
+        else:
+            self.profile.call(processor, run, dataset)
+
+    def run_in_parent(self, func, *args):
+        """
+        Call func(storage, *args) with the storage of the pipeline. In a parallel branch
+        (see run_branches), the call is sent back and made by the iterating processor
+        once the branch is done, in the order of the items, so this is the place for
+        things that can't be used from other threads or processes, like a database
+        connection. Otherwise it's called right away.
+        """
+        if self._parent_calls is None:
+            return func(self.storage, *args)
+        self._parent_calls.append((func, args))
+
+    def processors(self):
+        """This processor and all the ones after it in the chain."""
+        yield self
         if self.next_processor is not None:
-            self.next_processor.run(dataset)
+            yield from self.next_processor.processors()
+
+    def downstream_outputs(self):
+        keys = []
+        for processor in self.processors():
+            keys.extend(key for key in processor.outputs if key not in keys)
+        return keys
+
+    def set_executor(self, executor='thread', workers=None):
+        """
+        Make the iterating processors in the chain run their branches in parallel,
+        in a 'thread' or 'process' pool of 'workers' (one per CPU core by default).
+        Pass None to go back to running them one by one.
+        """
+        if executor is not None and executor not in executors:
+            raise ValueError("Unknown executor: {}".format(executor))
+        for processor in self.processors():
+            processor.executor = executor
+            processor.workers = workers
+
+    def set_profiling(self, enabled=True):
+        """
+        Record how long each processor in the chain takes, without changing any of
+        them. Returns the PipelineProfile, also available as self.profile:
+
+            profile = pipeline.set_profiling()
+            pipeline.run(data)
+            profile.print_tree()
+        """
+        profile = PipelineProfile() if enabled else None
+        for position, processor in enumerate(self.processors()):
+            processor.profile = profile
+            processor._position = position
+        return profile
+
+    def set_cache(self, cache, policy='use', max_bytes=1 << 30):
+        """
+        Cache the results of the processors in the chain that have cached = True,
+        in a ResultCache or a folder (holding at most max_bytes). The results are
+        keyed on the content of the dataset, the storage keys the processor declares
+        in 'inputs' and the processor's attributes, and a hit puts the declared
+        'outputs' back into storage. Side effects, like plotting, are skipped then.
+
+        'policy' is 'use' (use cached results), 'refresh' (recompute and replace
+        them) or 'off'. Pass cache=None to stop caching.
+        """
+        if cache is not None and not isinstance(cache, ResultCache):
+            cache = ResultCache(cache, max_bytes)
+        for processor in self.processors():
+            processor.cache = cache
+        self.set_cache_policy(policy)
+        return cache
+
+    def set_cache_policy(self, policy):
+        if policy not in cache_policies:
+            raise ValueError("Unknown cache policy: {}".format(policy))
+        for processor in self.processors():
+            processor.cache_policy = policy
+
+    def set_journal(self, journal):
+        """
+        Record the work finished by the pipeline in a RunJournal (or an SQLite file),
+        so that after a crash, pipeline.run(data, resume=True) skips it:
+
+            pipeline.set_journal('wafer.journal')
+            pipeline.run(data, resume=True)
+
+        A unit of work is an item of the first iterating processor in the chain (like
+        a dataset for ForEachProcessor), with everything after it. Units are keyed on
+        the item's cut (or its content, without one) and the configuration of the processors
+        that run on them (their attributes and the storage keys they read but don't write),
+        so changing that configuration recomputes them. Items with the same key raise a
+        ValueError, as the journal can't tell them apart. Skipped units don't run at all:
+        the 'outputs' and 'mutates' values they left in storage are restored, but side
+        effects, like plotting, are missed, and they give nothing to the iterating
+        processor (so no page for PdfPageProcessor).
+        Pass None to stop journaling.
+        """
+        if journal is not None and not isinstance(journal, RunJournal):
+            journal = RunJournal(journal)
+        for processor in self.processors():
+            processor.journal = journal
+        return journal
+
+    def _batch_stages(self):
+        # The processors after this one that can run a batch, up to the first that can't
+        stages = []
+        processor = self.next_processor
+        while (processor is not None and type(processor).run_batch is not None
+               and not (processor.cached and processor.cache is not None and processor.cache_policy != 'off')):
+            stages.append(processor)
+            processor = processor.next_processor
+        return stages
+
+    def _call_batch(self, processor, batch, storages):
+        if self.profile is None:
+            results = type(processor).run_batch(processor, batch, storages)
+        else:
+            results = self.profile.call(processor, _batch_run, (batch, storages), items=len(batch))
+        if len(results) != len(batch):
+            raise ValueError("{}.run_batch returned {} results for {} items".format(
+                type(processor).__name__, len(results), len(batch)))
+        return results
+
+    def run_batched(self, items):
+        """
+        Run the processors after this one that define run_batch on all the items at
+        once, then the rest of the pipeline on each of the results in turn. Returns
+        False, without running anything, if the items can't be batched: no executor
+        or journal can be set, the next processor needs a run_batch, and the items have
+        to be datasets with the same axes and shape. Processors with a cache set aren't
+        batched, so their results can be cached.
+
+        run_batch(batch, storages) gets a Batch of the datasets and a storage for
+        each of them, holding the results of the processors before it for that item,
+        to read from (writes to storage are shared by all the items). It returns a
+        list with, for each item, a dict of the values to put in its storage before
+        carrying on, None to stop there like a processor not calling run_next, or a
+        list of dicts to carry on once for each, like a processor calling run_next
+        more than once.
+
+        Once batched, storage is updated with each item's values in turn just before
+        the rest of the pipeline runs on it, so that gets the same storage as in a
+        chain. The batched processors themselves don't see what the rest of the
+        pipeline wrote for the items before.
+        """
+        stages = self._batch_stages()
+        if self.executor is not None or self.journal is not None or not stages:
+            return False
+        try:
+            batch = Batch(items)
+        except (ValueError, AttributeError, TypeError):
+            return False
+
+        storages = [ChainMap(self.storage) for item in batch]
+        for stage in stages:
+            results = self._call_batch(stage, batch, storages)
+            rows = []
+            new_storages = []
+            for i, result in enumerate(results):
+                if result is None:
+                    continue
+                for values in ([result] if isinstance(result, dict) else result):
+                    rows.append(i)
+                    new_storages.append(storages[i].new_child(values))
+            if not rows:
+                return True
+            batch = batch.select(rows)
+            storages = new_storages
+
+        last = stages[-1]
+        for dataset, storage in zip(batch, storages):
+            for values in reversed(storage.maps[:-1]):
+                self.storage.update(values)
+            last.run_next(dataset)
+        return True
+
+    def _clone(self, storage):
+        new = copy.copy(self)
+        new.storage = storage
+        # Only the outermost iterating processor fans out, branches run their own items in turn
+        new.executor = None
+        if self.next_processor is not None:
+            new.next_processor = self.next_processor._clone(storage)
+        return new
+
+    def branch(self, i, item):
+        """
+        Process one item of an iterating processor, see run_branches. By default,
+        this runs the rest of the pipeline on the item.
+        """
+        self.run_next(item)
+
+    def run_branches(self, items):
+        """
+        Call self.branch(i, item) for every item, yielding what it returns, in order.
+
+        With no executor set, this is just a loop. Otherwise the branches run in
+        parallel, each on its own copy of the rest of the chain and a copy-on-write
+        view of storage: they see everything in storage as it was before the first
+        branch started, but their writes stay separate. The keys declared in 'outputs'
+        by the processors after this one are then copied back into storage from each
+        branch in turn, in the order of items, so storage ends up the same as if the
+        branches had run one by one. Objects the processors change in place have to
+        be declared in 'mutates', so that every branch gets its own copy, and things
+        that can't be shared between threads or processes, like a database connection,
+        have to be used through run_in_parent.
+
+        Iterating processors inside a branch run their items one by one. For the
+        'process' executor, the processors and items have to be picklable, and values
+        in storage that aren't are left out of the branches' storage.
+
+        With a journal set (see set_journal), every item is a unit of work, recorded
+        once its branch is done.
+        """
+        if self.journal is not None:
+            yield from self.journal.run_units(self, items)
+            return
+        if self.executor is None:
+            for i, item in enumerate(items):
+                yield self.branch(i, item)
+            return
+
+        items = list(items)
+        # Every branch starts from storage as it is now, not as other branches leave it
+        snapshot = dict(self.storage) if self.executor != 'process' else _picklable(self.storage)
+        mutated = {key for p in self.processors() for key in p.mutates if key in snapshot}
+        clones = [self._clone(ChainMap({}, {key: copy.deepcopy(snapshot[key]) for key in mutated}, snapshot))
+                  for item in items]
+        with executors[self.executor](self.workers) as pool:
+            for result, written, timings, calls in pool.map(_run_branch, clones, range(len(items)), items):
+                self.storage.update(written)
+                if timings is not None:
+                    self.profile.merge(*timings)
+                for func, args in calls:
+                    func(self.storage, *args)
+                yield result
+
+
+class ForEachProcessor(DataProcessor):
+    """
+    Runs the rest of the pipeline for each dataset in a datalist or datadict,
+    in parallel if an executor is set (see set_executor), or batched if the next
+    processors support it (see run_batched).
+    """
+    fans_out = True
+
+    def run(self, dataset):
+        if self._timed(ForEachProcessor.run, dataset):
+            return
+        items = [dataset[key] for key in dataset] if hasattr(dataset, 'keys') else list(dataset)
+        if self.run_batched(items):
+            return
+        for _ in self.run_branches(items):
+            pass
+
+
+from .scheduler import dag, DagProcessor, UndeclaredKeyError
+from .streaming import Stream, files, Prefetch, SQLiteSink, PdfSink
@@ -0,0 +1,82 @@
+import copy
+
+import numpy as np
+
+
+class Batch:
+    """
+    Datasets with the same axes and shape, stacked along a new first axis for
+    DataProcessor.run_batch. Item i is batch[i], and the same dataset can be in
+    a batch more than once (like one item per peak of a spectrum).
+
+    'raw' is the (items, ...) array of their data, axis(key) the (items, length)
+    array of an axis' values, and take_raw(**i) works like dataset.take_raw for
+    all the items at once.
+    """
+    def __init__(self, datasets):
+        self.datasets = list(datasets)
+        if not self.datasets:
+            raise ValueError("A batch needs at least one dataset")
+        unique = {}
+        for x in self.datasets:
+            unique.setdefault(id(x), x)
+        positions = {key: i for i, key in enumerate(unique)}
+        # The row of the stack holding each item
+        self._rows = np.array([positions[id(x)] for x in self.datasets], dtype=np.intp)
+        self._unique = list(unique.values())
+
+        first = self._unique[0]
+        self.item_axes = list(first.axes)
+        shape = np.shape(first.raw)
+        if any(x.axes != first.axes or np.shape(x.raw) != shape for x in self._unique):
+            raise ValueError("Only datasets with the same axes and shape can be batched")
+        self._stack = np.stack([np.asarray(x.raw) for x in self._unique])
+        self._axes = {}
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def __getitem__(self, i):
+        return self.datasets[i]
+
+    def __iter__(self):
+        return iter(self.datasets)
+
+    def __repr__(self):
+        return "Batch({}, {})".format(len(self), ", ".join(
+            "{}[{}]".format(key, n) for key, n in zip(self.item_axes, self._stack.shape[1:])))
+
+    def _expand(self, stacked):
+        # Rows of an array stacked from the unique datasets, one per item
+        if len(self._rows) == len(stacked) and np.array_equal(self._rows, np.arange(len(stacked))):
+            return stacked
+        return stacked[self._rows]
+
+    @property
+    def raw(self):
+        return self._expand(self._stack)
+
+    def axis(self, key):
+        if key not in self._axes:
+            self._axes[key] = np.stack([np.asarray(x.axis(key)) for x in self._unique])
+        return self._expand(self._axes[key])
+
+    def take_raw(self, **i):
+        if all(isinstance(value, (int, np.integer)) for value in i.values()):
+            index = [slice(None)] * (len(self.item_axes) + 1)
+            for key in i:
+                index[self.item_axes.index(key) + 1] = i[key]
+            return self._expand(self._stack[tuple(index)])
+        s_raw = self._stack
+        new_ax_names = self.item_axes.copy()
+        for key in i:
+            s_raw = np.moveaxis(s_raw, new_ax_names.index(key) + 1, 1)[:, i[key]]
+            new_ax_names.remove(key)
+        return self._expand(s_raw)
+
+    def select(self, items):
+        """A batch of the given items (a list of indices, repeats allowed), sharing the stacked data."""
+        new_batch = copy.copy(self)
+        new_batch.datasets = [self.datasets[i] for i in items]
+        new_batch._rows = self._rows[np.asarray(items, dtype=np.intp)]
+        return new_batch
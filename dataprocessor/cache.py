@@ -0,0 +1,223 @@
+import hashlib
+import os
+import pickle
+import threading
+
+import numpy as np
+
+
+# Processor attributes that are part of the pipeline machinery rather than its configuration,
+# including the state a DagProcessor keeps about its stages (which are configured on their own)
+_machinery = {'pipeline', 'storage', 'next_processor', 'profile', 'cache', 'cache_policy',
+              'executor', 'workers', '_position', 'run', 'run_next', '_continued',
+              'journal', 'resume', '_parent_calls', 'stages', '_given', '_depends', '_late'}
+
+cache_policies = ('use', 'refresh', 'off')
+
+
+def _update(h, obj):
+    # Feed a description of obj's content into the hash h
+    if isinstance(obj, np.ndarray):
+        obj = np.ascontiguousarray(obj)
+        h.update(b"array" + obj.dtype.str.encode() + repr(obj.shape).encode())
+        if obj.dtype.hasobject:
+            h.update(pickle.dumps(obj.tolist()))
+        else:
+            h.update(obj.data.cast('B'))
+    elif hasattr(obj, 'raw') and hasattr(obj, 'ax_dict'):
+        # A dataset
+        h.update(b"dataset")
+        _update(h, np.asarray(obj.raw))
+        _update(h, obj.ax_dict)
+        _update(h, obj.cut)
+    elif hasattr(obj, 'datasets') and hasattr(obj, 'axis'):
+        # A datalist
+        h.update(b"datalist")
+        _update(h, obj.axes)
+        _update(h, list(obj.axis))
+        _update(h, obj.cut)
+        _update(h, obj.datasets)
+    elif hasattr(obj, 'dict') and hasattr(obj, 'keys'):
+        # A datadict
+        h.update(b"datadict" + repr(obj.name).encode())
+        _update(h, obj.cut)
+        _update(h, obj.dict)
+    elif isinstance(obj, dict):
+        h.update(b"dict%d" % len(obj))
+        for key in sorted(obj, key=repr):
+            _update(h, key)
+            _update(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(type(obj).__name__.encode() + b"%d" % len(obj))
+        for item in obj:
+            _update(h, item)
+    elif obj is None or isinstance(obj, (bool, int, float, complex, str, bytes, np.generic)):
+        h.update(type(obj).__name__.encode() + repr(obj).encode())
+    else:
+        # Anything else (like a PL_Subtractor2) is described by its state
+        h.update(type(obj).__module__.encode() + type(obj).__qualname__.encode())
+        state = getattr(obj, '__dict__', None)
+        if state is not None:
+            _update(h, {key: value for key, value in state.items() if key not in _machinery})
+        else:
+            h.update(pickle.dumps(obj))
+
+
+def fingerprint(*objs):
+    """A hash of the content of datasets, arrays and other objects, as a hex string."""
+    h = hashlib.blake2b(digest_size=20)
+    for obj in objs:
+        _update(h, obj)
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    An on-disk cache of processor results, see DataProcessor.set_cache. Each entry is
+    a small pickle file in 'folder', and once they take up more than max_bytes the
+    least recently used ones are deleted, down to 90% of max_bytes. The size is kept
+    as a running total, so the folder is only scanned when that goes over max_bytes
+    (and on the first put), rather than on every put.
+    """
+    def __init__(self, folder, max_bytes=1 << 30):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # The total size of the entries, None until the folder is first scanned
+        self._nbytes = None
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + '.pkl')
+
+    def get(self, key):
+        """The entry for key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        # Mark it as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, entry):
+        path = self._path(key)
+        temp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(temp, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        size = os.path.getsize(temp)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        os.replace(temp, path)
+        with self._lock:
+            if self._nbytes is not None:
+                self._nbytes += size - replaced
+            full = self._nbytes is None or self._nbytes > self.max_bytes
+        if full:
+            # Making some room means the next puts don't need to scan the folder again
+            self.evict(int(self.max_bytes * 0.9))
+
+    def evict(self, max_bytes=None):
+        """
+        Delete the least recently used entries until the cache fits in max_bytes,
+        self.max_bytes by default.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        with self._lock:
+            entries = []
+            with os.scandir(self.folder) as files:
+                for file in files:
+                    if file.name.endswith('.pkl'):
+                        stat = file.stat()
+                        entries.append((stat.st_mtime, stat.st_size, file.path))
+            total = sum(size for mtime, size, path in entries)
+            for mtime, size, path in sorted(entries):
+                if total <= max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+            self._nbytes = total
+
+    def clear(self):
+        with os.scandir(self.folder) as files:
+            for file in files:
+                if file.name.endswith('.pkl'):
+                    os.remove(file.path)
+        self._nbytes = 0
+
+    def key(self, processor, dataset):
+        """
+        The key for running processor on dataset: a fingerprint of the dataset, the
+        storage keys the processor declares as inputs and its own configuration.
+        """
+        inputs = {key: processor.storage.get(key) for key in processor.inputs
+                  if key not in processor.cache_ignore}
+        config = {key: value for key, value in vars(processor).items() if key not in _machinery}
+        cls = type(processor)
+        return fingerprint(cls.__module__, cls.__qualname__, getattr(processor, 'cache_version', 0),
+                           config, inputs, dataset)
+
+    def run(self, processor, dataset):
+        """
+        Run a cached processor, or restore its outputs from the cache and carry on
+        with the rest of the pipeline.
+        """
+        key = self.key(processor, dataset)
+        if processor.cache_policy == 'use':
+            entry = self.get(key)
+            if entry is not None:
+                self.hits += 1
+                continued, outputs = entry
+                processor.storage.update(outputs)
+                if continued:
+                    processor.run_next(dataset)
+                return
+        self.misses += 1
+
+        # The outputs are saved as soon as the processor hands over to the next one,
+        # before anything later in the pipeline can change them
+        saved = []
+        run_next = processor.run_next
+
+        def save_and_run_next(data):
+            if not saved:
+                saved.append(True)
+                self.put(key, (True, {k: processor.storage[k] for k in processor.outputs
+                                      if k in processor.storage}))
+            run_next(data)
+
+        # run_next may have been replaced on the instance already (see dag)
+        replaced = 'run_next' in vars(processor)
+        processor.run_next = save_and_run_next
+        try:
+            type(processor).run(processor, dataset)
+        finally:
+            if replaced:
+                processor.run_next = run_next
+            else:
+                del processor.run_next
+        if not saved:
+            self.put(key, (False, {k: processor.storage[k] for k in processor.outputs
+                                   if k in processor.storage}))
@@ -0,0 +1,163 @@
+import pickle
+import sqlite3
+import threading
+import time
+
+from .cache import fingerprint, _machinery
+
+
+_missing = object()
+
+
+def _describe(value):
+    # A fingerprint of value, or just of its type for things that can't be described
+    # (like a figure or a database connection)
+    try:
+        return fingerprint(value)
+    except Exception:
+        return fingerprint(type(value).__module__, type(value).__qualname__)
+
+
+def _cut(item):
+    # The cut of a branch item - a dataset, or a tuple holding one (like (dataset, name))
+    cut = getattr(item, 'cut', None)
+    if cut is None and isinstance(item, tuple):
+        for part in item:
+            cut = getattr(part, 'cut', None)
+            if cut is not None:
+                break
+    return cut
+
+
+class RunJournal:
+    """
+    A record of the work units finished by a pipeline, in an SQLite file, so that
+    a run that crashed or was stopped can carry on where it left off, see
+    DataProcessor.set_journal. Each unit is stored with the outputs it wrote to
+    storage, in the same transaction that marks it as finished.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.skipped = 0
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS units (unit TEXT, config TEXT, cut TEXT, "
+                               "outputs BLOB, finished REAL, PRIMARY KEY (unit, config))")
+
+    def __getstate__(self):
+        raise TypeError("A RunJournal can't be sent to another process")
+
+    def close(self):
+        self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM units").fetchone()[0]
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM units")
+
+    def unit_key(self, item):
+        """
+        The key for a branch item, from its cut (or its content if the cut is missing
+        or empty), and the cut as text to go with it.
+        """
+        cut = _cut(item)
+        return fingerprint(cut) if cut else _describe(item), repr(cut)
+
+    def config_key(self, processor):
+        """
+        A fingerprint of the configuration of processor and the ones after it: their
+        classes and attributes, and the storage keys they read but don't write.
+        """
+        processors = list(processor.processors())
+        produced = {key for p in processors for key in p.outputs}
+        parts = []
+        for p in processors:
+            cls = type(p)
+            config = {key: value for key, value in vars(p).items() if key not in _machinery}
+            inputs = {key: p.storage.get(key) for key in p.inputs
+                      if key not in produced and key not in p.cache_ignore}
+            parts.append((cls.__module__, cls.__qualname__, getattr(p, 'cache_version', 0),
+                          {key: _describe(value) for key, value in config.items()},
+                          {key: _describe(value) for key, value in inputs.items()}))
+        return fingerprint(parts)
+
+    def finished(self, unit, config):
+        """The outputs recorded for a finished unit, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT outputs FROM units WHERE unit = ? AND config = ?",
+                                     (unit, config)).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def record(self, unit, config, cut, outputs):
+        """Mark a unit as finished with its outputs, replacing records made with another configuration."""
+        try:
+            data = pickle.dumps(outputs, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # Keep what can be kept, like everything but a figure
+            kept = {}
+            for key, value in outputs.items():
+                try:
+                    pickle.dumps(value)
+                except Exception:
+                    continue
+                kept[key] = value
+            data = pickle.dumps(kept, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM units WHERE unit = ? AND config != ?", (unit, config))
+            self._conn.execute("INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?)",
+                               (unit, config, cut, data, time.time()))
+        self.recorded += 1
+
+    def run_units(self, processor, items):
+        """
+        Run the branches of an iterating processor (see DataProcessor.run_branches)
+        as units, skipping the finished ones if processor.resume is set.
+        """
+        config = self.config_key(processor)
+        storage = processor.storage
+        todo = []
+        units = {}
+        for i, item in enumerate(items):
+            unit, cut = self.unit_key(item)
+            if unit in units:
+                raise ValueError("Items {} and {} have the same key ({}), so the journal can't tell them apart".format(
+                    units[unit], i, cut))
+            units[unit] = i
+            outputs = self.finished(unit, config) if processor.resume else None
+            if outputs is not None:
+                storage.update(outputs)
+                self.skipped += 1
+            else:
+                todo.append((unit, cut, item))
+        if not todo:
+            return
+
+        # The units are only recorded here, not by iterating processors inside them
+        processors = list(processor.processors())
+        journals = [p.__dict__.get('journal', _missing) for p in processors]
+        results = None
+        try:
+            for p in processors:
+                p.journal = None
+            # Everything the processors declare they write or change in place, whether or
+            # not it's a new object (like a small int, or a tracker updated in place)
+            keys = processor.downstream_outputs()
+            keys.extend(key for p in processors for key in p.mutates if key not in keys)
+            results = processor.run_branches([item for unit, cut, item in todo])
+            for unit, cut, item in todo:
+                result = next(results)
+                self.record(unit, config, cut, {key: storage[key] for key in keys if key in storage})
+                yield result
+        finally:
+            if results is not None:
+                results.close()
+            for p, journal in zip(processors, journals):
+                if journal is _missing:
+                    del p.journal
+                else:
+                    p.journal = journal
@@ -1,13 +1,18 @@
+import copy
+
 from dataprocessor import DataProcessor
 import datasets1 as ds
 import numpy as np
 import scipy
-from scipy import signal, interpolate
+from scipy import signal
 from lmfit import Model
 from lmfit.models import PolynomialModel
 
 
 class SpectraProcessor(DataProcessor):
+    inputs = ('ax',)
+    outputs = ('spectra_plotted',)
+
     def run(self, dataset):
         ax = self.storage['ax']
         colours = ds.colours(dataset.power)
@@ -17,6 +22,8 @@ class SpectraProcessor(DataProcessor):
         self.run_next(dataset)
             
 class SumProcessor(DataProcessor):
+    inputs = ('ax',)
+
     def run(self, dataset):
         ax = self.storage['ax']
         ax.plot(dataset.power, dataset.take_sum('wl').raw)
@@ -24,17 +31,28 @@ class SumProcessor(DataProcessor):
         self.run_next(dataset)
 
 class FindPeaksProcessor(DataProcessor):
+    inputs = ('peak_prominence', 'plot_peaks', 'ax', 'spectra_plotted', 'pls')
+    outputs = ('peak_location',)
+    # Carries on once for every peak
+    fans_out = True
+    # find_boundaries changes pls in place
+    mutates = ('pls',)
+
+    def find_peaks(self, storage, dataset, I):
+        prominence = storage['peak_prominence'] if 'peak_prominence' in storage else 1000
+        peaks, _ = signal.find_peaks(I, prominence=prominence)
+        
+        if storage.get('plot_peaks', False) and 'ax' in storage:
+            if not storage.get("spectra_plotted", False):
+                storage['ax'].plot(dataset.wl, I)
+            storage['ax'].plot(dataset.wl[peaks], I[peaks], 'x')
+            # storage['ax'].plot([dataset.wl[0], dataset.wl[-1]], [np.mean(I[peaks])]*2)
+        return peaks
+
     def run(self, dataset, I=None):
-        prominence = self.storage['peak_prominence'] if 'peak_prominence' in self.storage else 1000
         if I is None:
             I = dataset.take_raw(power=-1)
-        peaks, _ = signal.find_peaks(I, prominence=prominence)
-        
-        if self.storage.get('plot_peaks', False) and 'ax' in self.storage:
-            if not self.storage.get("spectra_plotted", False):
-                self.storage['ax'].plot(dataset.wl, I)
-            self.storage['ax'].plot(dataset.wl[peaks], I[peaks], 'x')
-            # self.storage['ax'].plot([dataset.wl[0], dataset.wl[-1]], [np.mean(I[peaks])]*2)
+        peaks = self.find_peaks(self.storage, dataset, I)
             
         for peak in peaks:
             self.storage['peak_location'] = int(peak)
@@ -43,6 +61,22 @@ class FindPeaksProcessor(DataProcessor):
                 if self.storage.get('plot_peaks', False) and 'ax' in self.storage:
                     self.storage['ax'].text(dataset.wl[peak], I[peak], str(self.storage['pls'].fwhm))
                 self.run_next(dataset)
+
+    def run_batch(self, batch, storages):
+        # Every peak is passed on with its own copy of pls, as the later processors
+        # in the batch all run before the rest of the pipeline
+        results = []
+        for dataset, storage, I in zip(batch, storages, batch.take_raw(power=-1)):
+            found = []
+            for peak in self.find_peaks(storage, dataset, I):
+                pls = copy.copy(storage['pls'])
+                pls.find_boundaries(I, pi=peak)
+                if pls.fwhm < 20:
+                    if storage.get('plot_peaks', False) and 'ax' in storage:
+                        storage['ax'].text(dataset.wl[peak], I[peak], str(pls.fwhm))
+                    found.append({'peak_location': int(peak), 'pls': pls})
+            results.append(found)
+        return results
             
 
 class PL_Subtractor2:
@@ -69,9 +103,12 @@ class PL_Subtractor2:
         return I
 
     def set_pl_from_datalist(self, datalist, window=71):
-        avg_pl = np.nanmean([self.remove_peaks(d.take_raw(power=-1)) for d in datalist], axis=0)
+        # The highest power spectrum of every device, without copying the rest of the data
+        spectra = np.stack([d.take_raw(power=-1) for d in datalist])
+        avg_pl = np.nanmean([self.remove_peaks(I) for I in spectra], axis=0)
         self.diff = np.convolve(avg_pl, [1/window]*window, mode='same') - avg_pl
         self._diff_wl = datalist[0].wl
+        self._diff_data = ds.dataset(self.diff, wl=self._diff_wl)
         self._avg_pl = avg_pl
         
     def plot_pl_diff(self, ax):
@@ -114,7 +151,11 @@ class PL_Subtractor2:
         x = np.concatenate((wl[self.A:self.B], wl[self.C:self.D]))
         y = np.concatenate((I[self.A:self.B], I[self.C:self.D]))
 
-        diff_interp = interpolate.interp1d(self._diff_wl, self.diff, bounds_error=False, fill_value=0)
+        if getattr(self, '_diff_data', None) is None:
+            # Subtractors pickled before _diff_data existed only have diff and _diff_wl
+            self._diff_data = ds.dataset(self.diff, wl=self._diff_wl)
+        # The interpolation weights are cached, so this is cheap for every power of a peak
+        diff_interp = lambda x: self._diff_data.resample(wl=x, fill=0).raw
         diff_fast = diff_interp(x)
         
         def absorption_fast(x, mult=1):
@@ -135,30 +176,50 @@ class PL_Subtractor2:
 
 
 class MakePLSProcessor(DataProcessor):
+    outputs = ('pls',)
+    cached = True
+
     def run(self, dataset):
         self.storage['pls'] = pls = PL_Subtractor2()
         pls.set_pl_from_datalist(dataset)
         self.run_next(dataset)
 
 class PLSubProcessor(DataProcessor):
-    def run(self, dataset):
-        pls = self.storage['pls']
-        power = self.storage.get("power_values", dataset.power)
+    inputs = ('pls', 'power_values', 'plot_LL', 'ax')
+    outputs = ('LL_values',)
+    cached = True
+    # Only used for plotting
+    cache_ignore = ('power_values', 'plot_LL', 'ax')
+
+    def ll_values(self, storage, dataset):
+        pls = storage['pls']
+        power = storage.get("power_values", dataset.power)
         values = []
         for j in range(len(dataset.power)):
             x, y = pls.subtract_pl(dataset.wl, dataset.take_raw(power=j))
             values.append(np.sum(y))
-        self.storage['LL_values'] = values
             
-        if self.storage.get('plot_LL', False) and 'ax' in self.storage:
-            self.storage['ax'].plot(power, values)
-#             self.storage['ax'].loglog()
+        if storage.get('plot_LL', False) and 'ax' in storage:
+            storage['ax'].plot(power, values)
+#             storage['ax'].loglog()
+        return values
+
+    def run(self, dataset):
+        self.storage['LL_values'] = self.ll_values(self.storage, dataset)
         self.run_next(dataset)
+
+    def run_batch(self, batch, storages):
+        # Every spectrum is still fitted on its own, but this lets the processors
+        # around this one be batched
+        return [{'LL_values': self.ll_values(storage, dataset)} for dataset, storage in zip(batch, storages)]
   
 class DummySubProcessor(DataProcessor):
     """
     A silly test
     """
+    inputs = ('pls', 'plot_LL', 'ax')
+    outputs = ('LL_values',)
+
     def run(self, dataset):
         pls = self.storage['pls']
         values = []
@@ -171,12 +232,33 @@ class DummySubProcessor(DataProcessor):
 #             self.storage['ax'].loglog() 
         self.run_next(dataset)
 
+    def run_batch(self, batch, storages):
+        # (items, power, wl), so every item is summed in one go
+        raw = np.moveaxis(batch.raw, [batch.item_axes.index('power') + 1, batch.item_axes.index('wl') + 1], [1, 2])
+        results = []
+        for dataset, storage, spectra in zip(batch, storages, raw):
+            pls = storage['pls']
+            values = list(np.sum(spectra[:, pls.B:pls.C], axis=1))
+            if storage.get('plot_LL', False) and 'ax' in storage:
+                storage['ax'].plot(dataset.power, values)
+            results.append({'LL_values': values})
+        return results
+
 class DividePowerProcessor(DataProcessor):
+    outputs = ('power',)
+
     def run(self, dataset):
         self.storage['power'] = dataset.power/100.
         self.run_next(dataset)
 
+    def run_batch(self, batch, storages):
+        return [{'power': power} for power in batch.axis('power')/100.]
+
 class ConvertPowerProcessor(DataProcessor):
+    # power_file is only read when the processor is made
+    inputs = ('power', 'power_file')
+    outputs = ('power_values',)
+
     def __init__(self, pipeline=None, storage=None):
         percent, pW = np.genfromtxt(storage['power_file'], delimiter=',', unpack=True)
         percent /= 100
@@ -190,8 +272,15 @@ class ConvertPowerProcessor(DataProcessor):
         self.storage['power_values'] = self.p_to_power(power)
         self.run_next(dataset)
 
+    def run_batch(self, batch, storages):
+        power = np.array([storage.get('power', dataset.power) for dataset, storage in zip(batch, storages)])
+        return [{'power_values': values} for values in self.p_to_power(power)]
+
 # Trying to figure out the inflection point thing
 class InflectionProcessor(DataProcessor):
+    inputs = ('LL_values', 'power_values', 'plot_LL', 'ax')
+    outputs = ('inflection',)
+
     def run(self, dataset):
         I = self.storage['LL_values']
         power = self.storage.get("power_values", dataset.power)
@@ -215,11 +304,11 @@ class InflectionProcessor(DataProcessor):
         self.run_next(dataset)
 
 class ThresholdProcessor(DataProcessor):
-    def run(self, dataset):
-        I = self.storage['LL_values']
-        power = self.storage.get("power_values", dataset.power)
-        
-        if 'inflection' not in self.storage:
+    inputs = ('LL_values', 'power_values', 'inflection', 'plot_LL', 'ax')
+    outputs = ('ll_fit_range', 'threshold', 'll_slope', 'threshold_error')
+
+    def find_centre(self, storage, power, I):
+        if 'inflection' not in storage:
             # Get the inflection point from a smoothed curve
             window = 11
             pc = np.convolve(power, [1/window]*window, mode='valid')
@@ -228,9 +317,24 @@ class ThresholdProcessor(DataProcessor):
             der = Ic[1:]-Ic[:-1]
             centre = np.argmax(der) + window//2 + 1
         else:
-            centre = self.storage['inflection']
+            centre = storage['inflection']
         if centre >= len(power):
             centre = len(power)-1
+        return centre
+
+    def plot(self, storage, power, I, centre, x, y, fit):
+        if storage.get('plot_LL', False) and 'ax' in storage:
+            ax = storage['ax']
+            xx = np.linspace(-(fit[1]/fit[0]), x[-1])     
+            ax.plot(x, y, 'o-', ms=3)
+            ax.plot(xx, np.poly1d(fit)(xx))
+
+            ax.plot(power[centre], I[centre], 'o', ms=3)
+
+    def run(self, dataset):
+        I = self.storage['LL_values']
+        power = self.storage.get("power_values", dataset.power)
+        centre = self.find_centre(self.storage, power, I)
         end = 15 if centre>15 else centre+1
         
         # Fit linear functions repeatedly
@@ -254,11 +358,52 @@ class ThresholdProcessor(DataProcessor):
         self.storage['ll_slope'] = fit[0]
         self.storage['threshold_error'] = (np.sqrt(p[0,0])/abs(fit[0]) + np.sqrt(p[1,1])/abs(fit[1])) * -(fit[1]/fit[0])
         
-        if self.storage.get('plot_LL', False) and 'ax' in self.storage:
-            ax = self.storage['ax']
-            xx = np.linspace(-(fit[1]/fit[0]), x[-1])     
-            ax.plot(x, y, 'o-', ms=3)
-            ax.plot(xx, np.poly1d(fit)(xx))
-
-            ax.plot(power[centre], I[centre], 'o', ms=3)
+        self.plot(self.storage, power, I, centre, x, y, fit)
         self.run_next(dataset)
+
+    def run_batch(self, batch, storages):
+        # The same fits as run, for all the items at once
+        I = np.array([storage['LL_values'] for storage in storages], dtype=float)
+        power = np.array([storage.get("power_values", dataset.power) for dataset, storage in zip(batch, storages)],
+                         dtype=float)
+        centre = np.array([self.find_centre(storage, p, i) for storage, p, i in zip(storages, power, I)])
+        end = np.where(centre > 15, 15, centre + 1)
+        if np.any(end <= 2):
+            raise ValueError("The threshold can't be fitted for {}".format(batch[int(np.argmax(end <= 2))].cut))
+        distance = np.abs(np.arange(I.shape[1]) - centre[:, None])
+
+        # Like run, every expand up to end, which is 16 when the centre is 15
+        error = np.full((len(batch), end.max() - 2), np.inf)
+        for expand in range(2, end.max()):
+            use = expand < end
+            slope, intercept, p00, p11 = _line_fits(power[use], I[use], distance[use] <= expand)
+            error[use, expand-2] = (np.sqrt(p00)/abs(slope) + np.sqrt(p11)/abs(intercept)) * -(intercept/slope)
+        expand = np.argmin(error, axis=1) + 2
+
+        slope, intercept, p00, p11 = _line_fits(power, I, distance <= expand[:, None])
+        threshold = -(intercept/slope)
+        threshold_error = (np.sqrt(p00)/abs(slope) + np.sqrt(p11)/abs(intercept)) * threshold
+        results = []
+        for j, storage in enumerate(storages):
+            c, e = centre[j], expand[j]
+            self.plot(storage, power[j], I[j], c, power[j][c-e:c+e+1], I[j][c-e:c+e+1], (slope[j], intercept[j]))
+            results.append({'ll_fit_range': f"{c-e}:{c+e+1}", 'threshold': threshold[j],
+                            'll_slope': slope[j], 'threshold_error': threshold_error[j]})
+        return results
+
+
+def _line_fits(x, y, mask):
+    """
+    Straight lines fitted to the points of each row of x and y where mask is True,
+    as arrays of the slopes, intercepts and their variances, like np.polyfit(x, y, 1, cov=True).
+    """
+    n = mask.sum(1)
+    xm = np.where(mask, x, 0).sum(1) / n
+    ym = np.where(mask, y, 0).sum(1) / n
+    dx = np.where(mask, x - xm[:, None], 0)
+    dy = np.where(mask, y - ym[:, None], 0)
+    sxx = (dx**2).sum(1)
+    slope = (dx*dy).sum(1) / sxx
+    intercept = ym - slope*xm
+    scale = ((dy - slope[:, None]*dx)**2).sum(1) / (n - 2)
+    return slope, intercept, scale/sxx, scale*(1/n + xm**2/sxx)
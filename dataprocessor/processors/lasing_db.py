@@ -38,7 +38,17 @@ class DBInitProcessor(DataProcessor):
         self.storage['dbconn'].execute(self.storage['sp'].command_init())
         self.run_next(dataset)
             
+def _save_peak(storage, command, label_x):
+    # Runs where the database connection was made, see DataProcessor.run_in_parent
+    storage['dbcursor'].execute(*command)
+    storage['dbconn'].commit()
+    if storage.get('plot_LL', False) and 'ax' in storage:
+        storage['ax'].text(label_x, 0, "   " + str(storage['dbcursor'].lastrowid), size=8)
+
 class SavePeakProcessor(DataProcessor):
+    # The row is filled in on sp before being inserted
+    mutates = ('sp',)
+
     def run(self, dataset):
         sp = self.storage['sp']
         # sp['indices'] = f"{dataset.cut['dpmeta_page']}, {dataset.cut['dpmeta_row']}, {dataset.cut['dpmeta_col']}"
@@ -57,11 +67,7 @@ class SavePeakProcessor(DataProcessor):
         out.seek(0)
         sp['arrays'] = out.read()
         
-        self.storage['dbcursor'].execute(*sp.command_insert())
-        self.storage['dbconn'].commit()
+        # The database can only be used from the thread that connected to it
+        self.run_in_parent(_save_peak, sp.command_insert(), self.storage['threshold'])
         
-        if self.storage.get('plot_LL', False) and 'ax' in self.storage:
-            self.storage['ax'].text(self.storage['threshold'], 0,
-                                    "   " + str(self.storage['dbcursor'].lastrowid), size=8)
-        
-        self.run_next(dataset)
\ No newline at end of file
+        self.run_next(dataset)
@@ -6,7 +6,7 @@ from tqdm.autonotebook import tqdm
 import matplotlib.pyplot as plt
 
 
-def make_page(self, d, pdf, i, name=None):
+def build_page(self, d, pdf, i, name=None):
     # Make a Figure / page
     if pdf:
         self.storage['fig'] = fig = plt.Figure(constrained_layout=True)
@@ -35,14 +35,25 @@ def make_page(self, d, pdf, i, name=None):
         n_rows, n_cols, start, stop = ax.get_subplotspec().get_geometry()
         ax.set_subplotspec(gs[n_rows-1, n_cols-1])
 #                 print(fig.get_size_inches())
+    return fig
+
+def make_page(self, d, pdf, i, name=None):
+    fig = build_page(self, d, pdf, i, name)
     if pdf:
         pdf.savefig(fig)
 
 class PdfPageProcessor(DataProcessor):
     def run(self, dataset):
+        # Pages can be built in parallel (see DataProcessor.set_executor), but are saved in order
+        self._axis_name = dataset.axes[0]
         with (PdfPages(self.storage['pdf_name']) if self.storage['pdf_name'] else nullcontext()) as pdf:
-            for i, (d, dname) in enumerate(zip(tqdm(dataset), dataset.axis)):
-                make_page(self, d, pdf, i, f"{dataset.axes[0]}: {dname}")
+            for fig in self.run_branches(zip(tqdm(dataset), dataset.axis)):
+                if pdf:
+                    pdf.savefig(fig)
+
+    def branch(self, i, item):
+        d, dname = item
+        return build_page(self, d, self.storage['pdf_name'], i, f"{self._axis_name}: {dname}")
 
 class PdfPagePassthroughProcessor(DataProcessor):
     def run(self, dataset):
@@ -52,28 +63,37 @@ class PdfPagePassthroughProcessor(DataProcessor):
 
 class PlotGridProcessor(DataProcessor):
     def run(self, dataset):
-        for i, d in enumerate(tqdm(dataset)):
-            self.storage['r_i'] = i // 3
-            self.storage['c_i'] = i % 3
-            d.add_cut('dpmeta_row', i // 3)
-            d.add_cut('dpmeta_col', i % 3)
-            self.run_next(d)
+        for _ in self.run_branches(tqdm(dataset)):
+            pass
+
+    def branch(self, i, d):
+        self.storage['r_i'] = i // 3
+        self.storage['c_i'] = i % 3
+        d.add_cut('dpmeta_row', i // 3)
+        d.add_cut('dpmeta_col', i % 3)
+        self.run_next(d)
 
 class PlotRowsProcessor(DataProcessor):
     def run(self, dataset):
         # print('rows', len(dataset), dataset.cut)
-        for i, d in enumerate(tqdm(dataset)):
-            self.storage['r_i'] = i
-            d.add_cut('dpmeta_row', i)
-            self.run_next(d)
+        for _ in self.run_branches(tqdm(dataset)):
+            pass
+
+    def branch(self, i, d):
+        self.storage['r_i'] = i
+        d.add_cut('dpmeta_row', i)
+        self.run_next(d)
             
 class PlotColsProcessor(DataProcessor):
     def run(self, dataset):
         # print('cols', len(dataset), dataset.cut)
-        for i, d in enumerate(tqdm(dataset)):
-            d.add_cut('dpmeta_col', i)
-            self.storage['c_i'] = i
-            self.run_next(d)
+        for _ in self.run_branches(tqdm(dataset)):
+            pass
+
+    def branch(self, i, d):
+        d.add_cut('dpmeta_col', i)
+        self.storage['c_i'] = i
+        self.run_next(d)
 
 class PlotFirstColProcessor(DataProcessor):
     def run(self, dataset):
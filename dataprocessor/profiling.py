@@ -0,0 +1,124 @@
+import json
+import os
+import threading
+import time
+
+
+class PipelineProfile:
+    """
+    Timings of the processors in a pipeline, see DataProcessor.set_profiling.
+    'stats' maps (position in the chain, processor class name) to the number of calls,
+    the number of items they handled (more than one per call for run_batch), the
+    inclusive time (including the processors after it) and the exclusive time (just
+    its own work).
+
+    Branches run in parallel are recorded too (see DataProcessor.set_executor). The
+    iterating processor running them then counts the time spent waiting for them
+    as its own.
+    """
+    def __init__(self, max_events=100000):
+        self.max_events = max_events
+        self.stats = {}
+        self.events = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        # Whether this is a copy sent to another process with a parallel branch
+        self._copied = False
+
+    def __getstate__(self):
+        # Copies start empty, and are merged back after the branch (see merge)
+        state = self.__dict__.copy()
+        del state['_local'], state['_lock']
+        state['stats'] = {}
+        state['events'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._copied = True
+
+    def merge(self, stats, events):
+        """Add the stats and events recorded by a copy of this profile."""
+        with self._lock:
+            for key, other in stats.items():
+                totals = self.stats.setdefault(key, {'calls': 0, 'items': 0, 'inclusive': 0., 'exclusive': 0.})
+                for name in totals:
+                    totals[name] += other[name]
+            self.events.extend(events[:max(self.max_events - len(self.events), 0)])
+
+    def running(self):
+        """Whether a processor is being timed in this thread."""
+        return bool(getattr(self._local, 'stack', None))
+
+    def call(self, processor, run, dataset, items=1, **kwargs):
+        # 'items' is how many datasets the call handles, like the length of a batch
+        stack = self._local.__dict__.setdefault('stack', [])
+        # Time spent in the processors called from this one
+        stack.append(0.)
+        start = time.perf_counter()
+        try:
+            return run(processor, dataset, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            key = processor._position, type(processor).__name__
+            with self._lock:
+                stats = self.stats.get(key)
+                if stats is None:
+                    stats = self.stats[key] = {'calls': 0, 'items': 0, 'inclusive': 0., 'exclusive': 0.}
+                stats['calls'] += 1
+                stats['items'] += items
+                stats['inclusive'] += elapsed
+                stats['exclusive'] += elapsed - children
+                if len(self.events) < self.max_events:
+                    self.events.append((key, start, elapsed, os.getpid(), threading.get_ident()))
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+            self.events = []
+
+    def to_dict(self):
+        """The stats as a list of dicts, in chain order, ready for json."""
+        return [
+            {'position': position, 'processor': name, 'calls': stats['calls'], 'items': stats['items'],
+             'inclusive': stats['inclusive'], 'exclusive': stats['exclusive'],
+             'items_per_second': stats['items'] / stats['inclusive'] if stats['inclusive'] else None}
+            for (position, name), stats in sorted(self.stats.items())
+        ]
+
+    def save_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def tree(self):
+        """The stats as a table, indented by position in the chain."""
+        lines = ["{:<40} {:>8} {:>8} {:>11} {:>11} {:>10}".format(
+            'processor', 'calls', 'items', 'inclusive s', 'exclusive s', 'items/s')]
+        for row in self.to_dict():
+            name = "  " * row['position'] + row['processor']
+            rate = row['items_per_second']
+            lines.append("{:<40} {:>8} {:>8} {:>11.4f} {:>11.4f} {:>10}".format(
+                name, row['calls'], row['items'], row['inclusive'], row['exclusive'],
+                "{:.4g}".format(rate) if rate is not None else '-'))
+        return "\n".join(lines)
+
+    def print_tree(self, file=None):
+        print(self.tree(), file=file)
+
+    def chrome_trace(self):
+        """The recorded calls in the Chrome trace format, for chrome://tracing or Perfetto."""
+        return {'traceEvents': [
+            {'name': name, 'cat': 'dataprocessor', 'ph': 'X', 'pid': pid, 'tid': tid,
+             'ts': (start - self._start) * 1e6, 'dur': elapsed * 1e6, 'args': {'position': position}}
+            for (position, name), start, elapsed, pid, tid in self.events
+        ]}
+
+    def save_trace(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.chrome_trace(), f)
@@ -0,0 +1,226 @@
+import copyreg
+import functools
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import DataProcessor, _cached_run
+
+
+_missing = object()
+
+
+class UndeclaredKeyError(Exception):
+    """A DAG stage used a storage key it didn't declare in its inputs or outputs."""
+
+
+class _StageStorage(MutableMapping):
+    """
+    The storage seen by a DAG stage. While the DAG runs, only declared keys can
+    be used, and keys produced by later stages read as they were before it started.
+    """
+    def __init__(self, storage, stage):
+        self._storage = storage
+        self._name = stage.__name__
+        self._reads = set(stage.inputs) | set(stage.outputs)
+        self._writes = set(stage.outputs)
+        self._before = None
+        # Declarations are only checked while running, not when the stage is made
+        self._running = False
+
+    def _check(self, key):
+        if not self._running:
+            return self._storage
+        if key not in self._reads:
+            raise UndeclaredKeyError("{} used '{}', which is not in its inputs".format(self._name, key))
+        if self._before is not None and key in self._before:
+            return self._before[key]
+        return self._storage
+
+    def __getitem__(self, key):
+        return self._check(key)[key]
+
+    def __contains__(self, key):
+        return key in self._check(key)
+
+    def get(self, key, default=None):
+        return self._check(key).get(key, default)
+
+    def __setitem__(self, key, value):
+        if self._running and key not in self._writes:
+            raise UndeclaredKeyError("{} wrote '{}', which is not in its outputs".format(self._name, key))
+        self._storage[key] = value
+
+    def __delitem__(self, key):
+        if self._running and key not in self._writes:
+            raise UndeclaredKeyError("{} deleted '{}', which is not in its outputs".format(self._name, key))
+        del self._storage[key]
+
+    def __iter__(self):
+        return (key for key in self._storage if key in self._reads or not self._running)
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+
+class _DagType(type):
+    pass
+
+
+def _continue(stage, dataset):
+    if stage._continued:
+        raise ValueError("{} called run_next more than once, which a DAG stage can't do".format(
+            type(stage).__name__))
+    stage._continued = True
+
+
+class DagProcessor(DataProcessor):
+    """
+    Runs its stages (see dag) as a dependency graph, then carries on with the
+    rest of the pipeline.
+    """
+    stage_classes = ()
+    dag_workers = None
+    skip_present = False
+
+    def __init__(self, pipeline=None, storage=None):
+        super().__init__(pipeline, storage)
+        self.stages = [self._make_stage(cls([], _StageStorage(self.storage, cls))) for cls in self.stage_classes]
+        self._plan()
+        # The outputs that were given in storage when the DAG was made. Only these can
+        # be skipped, and only while they still hold the same value, not ones written
+        # since by the pipeline or restored from a journal.
+        self._given = {key: self.storage[key] for key in self.outputs if key in self.storage}
+
+    def _make_stage(self, stage):
+        # Stages don't run the rest of the pipeline, they just note whether they would
+        stage._continued = False
+        stage.run_next = functools.partial(_continue, stage)
+        return stage
+
+    def _plan(self):
+        # Each stage depends on the closest earlier stage producing each of its inputs.
+        # Inputs only produced by later stages are read as they were before the DAG ran.
+        self._depends = []
+        self._late = []
+        for i, stage in enumerate(self.stages):
+            depends = set()
+            late = set()
+            for key in stage.inputs:
+                producers = [j for j, other in enumerate(self.stages) if key in other.outputs and j != i]
+                earlier = [j for j in producers if j < i]
+                if earlier:
+                    depends.add(earlier[-1])
+                elif producers:
+                    late.add(key)
+            # Writing the same key as an earlier stage has to happen after it
+            for key in stage.outputs:
+                depends.update(j for j in range(i) if key in self.stages[j].outputs)
+            self._depends.append(depends)
+            self._late.append(late)
+
+    def processors(self):
+        yield self
+        yield from self.stages
+        if self.next_processor is not None:
+            yield from self.next_processor.processors()
+
+    def _clone(self, storage):
+        new = super()._clone(storage)
+        new.stages = [self._make_stage(stage._clone(_StageStorage(storage, type(stage))))
+                      for stage in self.stages]
+        return new
+
+    def _run_stage(self, stage, dataset):
+        stage._continued = False
+        if stage.cached and stage.cache is not None and stage.cache_policy != 'off':
+            run = _cached_run
+        else:
+            run = type(stage).run
+        stage.storage._running = True
+        try:
+            if self.profile is None:
+                run(stage, dataset)
+            else:
+                self.profile.call(stage, run, dataset)
+        finally:
+            stage.storage._running = False
+        return stage._continued
+
+    def _skipped(self, stage):
+        return (self.skip_present and stage.outputs
+                and all(key in self._given and self.storage.get(key, _missing) is self._given[key]
+                        for key in stage.outputs))
+
+    def run(self, dataset):
+        if self._timed(DagProcessor.run, dataset):
+            return
+        for stage, late in zip(self.stages, self._late):
+            if late:
+                before = {key: self.storage[key] for key in late if key in self.storage}
+                stage.storage._before = {key: before for key in late}
+            else:
+                stage.storage._before = None
+
+        done = {i for i, stage in enumerate(self.stages) if self._skipped(stage)}
+        waiting = [i for i in range(len(self.stages)) if i not in done]
+        stopped = False
+        with ThreadPoolExecutor(self.dag_workers) as pool:
+            running = {}
+            while waiting or running:
+                if not stopped:
+                    for i in [i for i in waiting if self._depends[i] <= done]:
+                        waiting.remove(i)
+                        running[pool.submit(self._run_stage, self.stages[i], dataset)] = i
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    i = running.pop(future)
+                    # Any exception is raised here, and no more stages are started
+                    if not future.result():
+                        # Like a processor not calling run_next, this stops the pipeline
+                        stopped = True
+                    done.add(i)
+        if not stopped:
+            self.run_next(dataset)
+
+
+@functools.lru_cache(maxsize=None)
+def dag(*stages, workers=None, skip_present=False):
+    """
+    Make a processor that runs 'stages' (processor classes) as a dependency graph
+    built from the storage keys they declare in 'inputs' and 'outputs', then carries
+    on with the rest of the pipeline:
+
+        DataProcessor([ForEachProcessor, dag(PLSubProcessor, ConvertPowerProcessor,
+                                            ThresholdProcessor), SavePeakProcessor], storage)
+
+    Each stage waits for the stages before it that produce its inputs, and otherwise
+    runs alongside them in a pool of 'workers' threads. A stage reading a key that's
+    only produced by a later stage sees it as it was before, like in a plain chain.
+    Using an undeclared key raises an UndeclaredKeyError.
+
+    With skip_present=True, stages whose outputs were all in storage when the pipeline
+    was made are skipped, for as long as storage still holds those values. Stages are run on their own, so they can call run_next at most once,
+    and ones with fans_out set (like FindPeaksProcessor) raise a ValueError here.
+    If one doesn't call it, the pipeline stops there for this dataset, as it would in a chain.
+    """
+    for stage in stages:
+        if stage.fans_out:
+            raise ValueError("{} can call run_next more than once, so it can't be a DAG stage".format(
+                stage.__name__))
+    return _DagType('DagProcessor', (DagProcessor,), {
+        'stage_classes': stages,
+        'dag_workers': workers,
+        'skip_present': skip_present,
+        'inputs': tuple(sorted({key for stage in stages for key in stage.inputs})),
+        'outputs': tuple(sorted({key for stage in stages for key in stage.outputs})),
+    })
+
+
+def _dag_class(stages, workers, skip_present):
+    return dag(*stages, workers=workers, skip_present=skip_present)
+
+
+# The classes made by dag are pickled (to send them to another process) as how to remake them
+copyreg.pickle(_DagType, lambda cls: (_dag_class, (cls.stage_classes, cls.dag_workers, cls.skip_present)))
@@ -0,0 +1,354 @@
+import collections
+import functools
+import queue
+import sqlite3
+import threading
+import time
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+
+def _buffered(items, size):
+    # Iterate over items in a background thread, at most 'size' items ahead of the consumer
+    q = queue.Queue(size)
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                q.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fill():
+        try:
+            for item in items:
+                if not put((True, item)):
+                    return
+        except BaseException as e:
+            put((False, e))
+        else:
+            put((False, None))
+        finally:
+            # Let the stages before this one stop too
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=fill, daemon=True)
+    thread.start()
+    try:
+        while True:
+            ok, item = q.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def _reached_end(results, storage, dataset):
+    results.append((dataset, dict(storage.maps[0])))
+
+
+def _process(pipeline, items):
+    for item in items:
+        # A fresh layer of storage for every item, so results don't pile up
+        storage = ChainMap({}, pipeline.storage)
+        head = pipeline._clone(storage)
+        last = head
+        while last.next_processor is not None:
+            last = last.next_processor
+        results = []
+        last.run_next = functools.partial(_reached_end, results, storage)
+        if head.profile is None:
+            type(head).run(head, item)
+        else:
+            head.profile.call(head, type(head).run, item)
+        yield from results
+
+
+class Stream:
+    """
+    A pull-based pipeline: items come lazily from a source, go through stages that
+    transform or filter them, and are pulled out at the end by iterating or by
+    a sink. Every stage (and the source) runs in its own thread, with a queue of
+    at most 'buffer' items after it, so a slow stage holds the ones before it back
+    and only a few items are in memory at once however many there are:
+
+        (Stream(files(index.where(X=3), ds.load))
+            .filter(lambda d: d.raw.max() > 100)
+            .process(DataProcessor([FindPeaksProcessor, PLSubProcessor, ThresholdProcessor], storage))
+            .into(SQLiteSink('thresholds.db', 'thresholds')))
+
+    Nothing runs until the stream is iterated, and it can only be iterated once.
+    An exception in a stage is raised where the stream is iterated.
+    """
+    def __init__(self, source, buffer=4):
+        self.buffer = buffer
+        self._items = _buffered(source, buffer)
+
+    def __iter__(self):
+        return self._items
+
+    def _then(self, stage, buffer):
+        return Stream(stage(self._items), self.buffer if buffer is None else buffer)
+
+    def map(self, func, buffer=None):
+        """Replace every item with func(item)."""
+        return self._then(functools.partial(map, func), buffer)
+
+    def filter(self, func, buffer=None):
+        """Keep the items for which func(item) is true."""
+        return self._then(functools.partial(filter, func), buffer)
+
+    def process(self, pipeline, buffer=None):
+        """
+        Run a DataProcessor pipeline on every item, giving a (dataset, values) pair
+        each time the end of the pipeline is reached, 'values' being what the pipeline
+        wrote to storage for it. Every item gets a fresh layer of storage on top of
+        pipeline.storage, so nothing is kept between items.
+        """
+        return self._then(functools.partial(_process, pipeline), buffer)
+
+    def into(self, sink):
+        """
+        Pass every item to sink(item), returning how many there were. Sinks with
+        a close method are closed at the end.
+        """
+        n = 0
+        try:
+            for item in self:
+                sink(item)
+                n += 1
+        finally:
+            close = getattr(sink, 'close', None)
+            if close is not None:
+                close()
+        return n
+
+
+def files(paths, load=None, **kwargs):
+    """
+    Load the files in 'paths' one by one as they're needed, with load(path, **kwargs)
+    (datasets.load by default). For a FileTable, like a FileIndex query, the values
+    parsed from each filename are added to what's loaded as cuts.
+    """
+    if load is None:
+        from datasets import load
+    columns = getattr(paths, 'columns', {})
+    for i, path in enumerate(paths):
+        yield _add_columns(load(path, **kwargs), columns, i)
+
+
+def _add_columns(data, columns, i):
+    # Add the values parsed from a filename in a FileTable as cuts
+    for key, column in columns.items():
+        if not np.isnan(column[i]):
+            data.add_cut(key, int(column[i]) if float(column[i]).is_integer() else float(column[i]))
+    return data
+
+
+def _nbytes(obj):
+    # Roughly how much memory a loaded file takes, from the arrays in it
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if hasattr(obj, 'raw') and hasattr(obj, 'axes'):
+        raw = obj.raw
+        return getattr(raw, 'nbytes', 0) + sum(np.asarray(obj.axis(key)).nbytes for key in obj.axes)
+    if hasattr(obj, 'datasets'):
+        return sum(_nbytes(x) for x in obj.datasets)
+    if hasattr(obj, 'dict'):
+        return sum(_nbytes(x) for x in obj.dict.values())
+    if isinstance(obj, dict):
+        # Like what scipy.io.loadmat gives
+        return sum(_nbytes(x) for x in obj.values())
+    return 0
+
+
+class Prefetch:
+    """
+    Loads the files in 'paths' in order, with load(path, **kwargs) (datasets.load by
+    default, or a loader for SPE or .mat files), reading the next ones in background
+    threads while the current one is being used:
+
+        for data in Prefetch(index.where(X=3), ds.load, ahead=4):
+            pipeline.run(data)
+
+    Up to 'ahead' files are read ahead of the one being used, and no more than about
+    max_bytes of them are kept loaded (judging by the size of the files loaded so far).
+    For a FileTable, like a FileIndex query, the values parsed from each filename are
+    added as cuts, as with files.
+
+    'hits' counts the files that were ready when needed and 'stalls' those that had to
+    be waited for, 'stall_time' being the total wait in seconds and 'peak_bytes' the
+    most loaded at once. Lots of stalls mean 'ahead' (or max_bytes) could be raised,
+    or more 'workers' used - by default there's one per file read ahead.
+    """
+    def __init__(self, paths, load=None, ahead=4, max_bytes=None, workers=None, **kwargs):
+        if load is None:
+            from datasets import load
+        self.paths = paths
+        self.load = load
+        self.kwargs = kwargs
+        self.ahead = ahead
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.hits = 0
+        self.stalls = 0
+        self.stall_time = 0.
+        self.loaded = 0
+        self.loaded_bytes = 0
+        self.peak_bytes = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "Prefetch({} hits, {} stalls, {:.3g} s stalled, {:.3g} MB peak)".format(
+            self.hits, self.stalls, self.stall_time, self.peak_bytes / 1e6)
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'stalls': self.stalls, 'stall_time': self.stall_time,
+                'loaded': self.loaded, 'loaded_bytes': self.loaded_bytes, 'peak_bytes': self.peak_bytes}
+
+    def _load(self, columns, i, path):
+        data = _add_columns(self.load(path, **self.kwargs), columns, i)
+        nbytes = _nbytes(data)
+        with self._lock:
+            self.loaded += 1
+            self.loaded_bytes += nbytes
+        return data, nbytes
+
+    def _room(self, pending, current):
+        # Whether another file can be read, with 'current' bytes in use already. Files
+        # that failed to load take no room, their error is raised when they're reached.
+        done = sum(future.result()[1] for future in pending
+                   if future.done() and future.exception() is None)
+        self.peak_bytes = max(self.peak_bytes, current + done)
+        if len(pending) >= self.ahead:
+            return False
+        if self.max_bytes is None or not pending:
+            return True
+        with self._lock:
+            if not self.loaded:
+                # Wait to see how big the files are
+                return False
+            average = self.loaded_bytes / self.loaded
+        waiting = sum(1 for future in pending if not future.done())
+        return current + done + (waiting + 1) * average <= self.max_bytes
+
+    def __iter__(self):
+        columns = getattr(self.paths, 'columns', {})
+        paths = enumerate(self.paths)
+        pending = collections.deque()
+        with ThreadPoolExecutor(self.workers or self.ahead) as pool:
+            try:
+                def fill(current):
+                    while self._room(pending, current):
+                        i, path = next(paths, (None, None))
+                        if path is None:
+                            return
+                        pending.append(pool.submit(self._load, columns, i, path))
+
+                fill(0)
+                while pending:
+                    future = pending.popleft()
+                    if future.done():
+                        self.hits += 1
+                    else:
+                        self.stalls += 1
+                        start = time.perf_counter()
+                        wait([future])
+                        self.stall_time += time.perf_counter() - start
+                    data, nbytes = future.result()
+                    # Start the next reads before handing this one over
+                    fill(nbytes)
+                    yield data
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+def _row(item):
+    # The cut and the single values stored by a pipeline, see Stream.process
+    dataset, values = item
+    row = {key: value for key, value in dataset.cut.items() if np.isscalar(value)}
+    row.update((key, value) for key, value in values.items() if np.isscalar(value))
+    return row
+
+
+class SQLiteSink:
+    """
+    Writes items into a table of an SQLite database, one row per item. row(item)
+    gives the row as a dict of columns, by default the cut and single values of a
+    (dataset, values) pair from Stream.process. The table is created with the
+    columns of the first row if needed. Rows are committed every 'commit_every'
+    and at the end.
+    """
+    def __init__(self, filename, table, row=_row, commit_every=100):
+        self.table = table
+        self.row = row
+        self.commit_every = commit_every
+        self.rows = 0
+        self._conn = sqlite3.connect(filename)
+        self._columns = None
+
+    def __call__(self, item):
+        row = self.row(item)
+        if self._columns is None:
+            self._columns = list(row)
+            self._conn.execute('CREATE TABLE IF NOT EXISTS "{}" ({})'.format(
+                self.table, ", ".join('"{}"'.format(key) for key in self._columns)))
+        values = [row.get(key) for key in self._columns]
+        self._conn.execute('INSERT INTO "{}" ({}) VALUES ({})'.format(
+            self.table, ", ".join('"{}"'.format(key) for key in self._columns), ", ".join("?" * len(values))),
+            [value.item() if isinstance(value, np.generic) else value for value in values])
+        self.rows += 1
+        if self.rows % self.commit_every == 0:
+            self._conn.commit()
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+
+class PdfSink:
+    """
+    Plots items onto pages of a PDF file, in a grid of rows x cols axes per page,
+    calling plot(ax, item) for each. Every page is saved as soon as it's full,
+    so only one is in memory at a time.
+    """
+    def __init__(self, filename, plot, rows=3, cols=3):
+        from matplotlib.backends.backend_pdf import PdfPages
+        self.plot = plot
+        self.rows = rows
+        self.cols = cols
+        self._pdf = PdfPages(filename)
+        self._fig = None
+        self._n = 0
+
+    def __call__(self, item):
+        import matplotlib.pyplot as plt
+        if self._fig is None:
+            self._fig = plt.Figure(figsize=(self.cols*2, self.rows*2), constrained_layout=True)
+        ax = self._fig.add_subplot(self.rows, self.cols, self._n + 1)
+        self.plot(ax, item)
+        self._n += 1
+        if self._n == self.rows*self.cols:
+            self._save_page()
+
+    def _save_page(self):
+        self._pdf.savefig(self._fig)
+        self._fig = None
+        self._n = 0
+
+    def close(self):
+        if self._fig is not None:
+            self._save_page()
+        self._pdf.close()
@@ -37,6 +37,22 @@ import os
 import re
 import pickle
 import gzip
+import io
+import struct
+import zlib
+import lzma
+import copy
+import threading
+import fnmatch
+import time
+import sys
+import json
+import atexit
+import contextlib
+import tracemalloc
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import functools
 from glob import glob as _glob
 
 
@@ -91,7 +107,17 @@ def extract(string, *patterns):
     associated numbers from the string. For example, '_P_' as a pattern will match '_P_123'
     in a filename and return 123.
     """
-    return [int(re.search(pattern+"([0-9]+)", string).group(1)) for pattern in patterns]
+    return [int(_number_regex(pattern).search(string).group(1)) for pattern in patterns]
+
+
+_number_regexes = {}
+
+
+def _number_regex(pattern):
+    try:
+        return _number_regexes[pattern]
+    except KeyError:
+        return _number_regexes.setdefault(pattern, re.compile(pattern+"([0-9]+)"))
 
 
 def extract_raw(string, *patterns):
@@ -111,7 +137,7 @@ def extract_unique(files, pattern):
 
 def _sort_key(x, pattern):
     try:
-        return int(re.search(pattern+"([0-9]+)", x).group(1))
+        return int(_number_regex(pattern).search(x).group(1))
     except AttributeError:
         return 1e10
 
@@ -128,6 +154,231 @@ def sort_by(files, pattern):
     files.sort(key=lambda x:_sort_key(x, pattern))
 
 
+def _pattern_name(pattern):
+    name = pattern.strip('_')
+    return name if name.isidentifier() else pattern
+
+
+class FileTable:
+    """
+    A list of file paths with a numeric column for each filename pattern, as produced
+    by FileIndex. Missing values are nan. Queries return new FileTables, so they chain:
+
+        index.where(X=3, Y=5).sort_by('P')
+
+    Iterating gives the paths, and table['P'] gives a column.
+    """
+    def __init__(self, paths, patterns, columns):
+        self.paths = paths
+        self.patterns = patterns
+        self.columns = columns
+
+    def _subset(self, rows):
+        return FileTable(self.paths[rows], self.patterns,
+                         {key: value[rows] for key, value in self.columns.items()})
+
+    def _column_name(self, name):
+        if name in self.columns:
+            return name
+        if name in self.patterns:
+            return _pattern_name(name)
+        raise KeyError(name)
+
+    def __getitem__(self, name):
+        return self.columns[self._column_name(name)]
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(["{} files".format(len(self))] + list(self.columns)))
+
+    @property
+    def files(self):
+        return list(self.paths)
+
+    def where(self, **params):
+        """
+        Select the files whose parameters match, for example where(X=3, Y=5).
+        A list, tuple, set or array matches any of its values.
+        """
+        mask = np.ones(len(self), bool)
+        for key, value in params.items():
+            column = self[key]
+            if isinstance(value, (list, tuple, set, np.ndarray)):
+                mask &= np.isin(column, list(value))
+            else:
+                mask &= column == value
+        return self._subset(mask)
+
+    def filter(self, match='*', yes=[], no=[]):
+        """
+        Select the files whose name matches the Unix-style pattern 'match', like glob.
+        'yes' and 'no' are strings that should/should not be in the full path.
+        """
+        keep = [fnmatch.fnmatch(os.path.basename(x), match)
+                and all(s in x for s in yes) and not any(s in x for s in no)
+                for x in self.paths]
+        return self._subset(np.asarray(keep, bool))
+
+    def sort_by(self, *names):
+        """
+        Sort by one or more parameters, the first being the primary key. The sort is
+        stable and files missing a parameter go last, as with sort_by.
+        """
+        return self._subset(np.lexsort([self[x] for x in names[::-1]]))
+
+    def unique(self, name):
+        """Sorted unique values of a parameter, like extract_unique."""
+        column = self[name]
+        return np.unique(column[~np.isnan(column)]).astype(np.int64)
+
+
+class FileIndex(FileTable):
+    """
+    An index of the numeric parameters in the filenames of a folder. The folder is
+    scanned once with os.scandir and every filename is parsed against each pattern
+    (as in extract) into a column, so queries don't need to touch the disk again:
+
+        index = FileIndex(folder, patterns=['_P_', '_I_', '_X_', '_Y_'])
+        for path in index.where(X=3, Y=5).sort_by('P'):
+            ...
+
+    The index is kept in a JSON sidecar file in the folder and refreshed incrementally:
+    only directories whose mtime changed are listed again, and only new names are
+    parsed. Pass sidecar=None to keep it in memory only.
+    """
+    _version = 2
+
+    def __init__(self, folder, patterns=[], recursive=False, sidecar='.dsindex'):
+        self.folder = folder
+        self.recursive = recursive
+        self.sidecar = None if sidecar is None else os.path.join(folder, sidecar)
+        self._dirs = {}
+        super().__init__(np.array([], str), list(patterns), {})
+        self._read_sidecar()
+        self.refresh()
+
+    def _read_sidecar(self):
+        if self.sidecar is None:
+            return
+        try:
+            with open(self.sidecar, 'r') as f:
+                state = json.load(f)
+            if state['version'] == self._version and state['recursive'] == self.recursive:
+                for entry in state['dirs'].values():
+                    entry['values'] = {key: np.array(value, float) for key, value in entry['values'].items()}
+                self._dirs = state['dirs']
+        except FileNotFoundError:
+            # Create the sidecar before the folder is stat-ed, as creating it
+            # later would change the folder's mtime and force a rescan next time
+            try:
+                open(self.sidecar, 'ab').close()
+            except OSError:
+                self.sidecar = None
+        except Exception:
+            # A broken sidecar just means a full scan
+            pass
+
+    def _write_sidecar(self):
+        # JSON rather than a pickle, so that reading it can't run code from the folder
+        dirs = {rel: dict(entry, values={key: value.tolist() for key, value in entry['values'].items()})
+                for rel, entry in self._dirs.items()}
+        state = {'version': self._version, 'recursive': self.recursive, 'dirs': dirs}
+        try:
+            # Rewriting the file in place leaves the folder's mtime alone
+            with open(self.sidecar, 'w') as f:
+                json.dump(state, f)
+        except OSError:
+            pass
+
+    def _scan(self, rel, mtime, old):
+        files, dirs = [], []
+        sidecar = os.path.basename(self.sidecar) if self.sidecar and not rel else None
+        with os.scandir(os.path.join(self.folder, rel)) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                elif entry.name != sidecar:
+                    files.append(entry.name)
+        files.sort()
+        dirs.sort()
+        # Carry over the values already parsed for files that are still there
+        values = {}
+        if old is not None:
+            rows = {name: i for i, name in enumerate(old['files'])}
+            keep = [(i, rows[name]) for i, name in enumerate(files) if name in rows]
+            if keep:
+                new, prev = np.array(keep).T
+                for pattern, column in old['values'].items():
+                    values[pattern] = np.full(len(files), np.nan)
+                    values[pattern][new] = column[prev]
+                values['_parsed'] = np.zeros(len(files), bool)
+                values['_parsed'][new] = True
+        return {'mtime': mtime, 'files': files, 'dirs': dirs, 'values': values}
+
+    def _parse(self, entry):
+        values = entry['values']
+        parsed = values.pop('_parsed', None)
+        for pattern in self.patterns:
+            if pattern in values and parsed is None:
+                continue
+            regex = _number_regex(pattern)
+            column = values.get(pattern)
+            if column is None:
+                column = np.full(len(entry['files']), np.nan)
+                todo = range(len(entry['files']))
+            else:
+                todo = np.flatnonzero(~parsed)
+            for i in todo:
+                match = regex.search(entry['files'][i])
+                if match:
+                    column[i] = int(match.group(1))
+            values[pattern] = column
+
+    def refresh(self):
+        """
+        Bring the index up to date with the folder. Called on creation, so only
+        needed if the index is kept around while files are added.
+        """
+        changed = False
+        dirs = {}
+        todo = ['']
+        while todo:
+            rel = todo.pop()
+            path = os.path.join(self.folder, rel)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            entry = self._dirs.get(rel)
+            if entry is None or entry['mtime'] != mtime:
+                entry = self._scan(rel, mtime, entry)
+                changed = True
+            if any(x not in entry['values'] for x in self.patterns) or '_parsed' in entry['values']:
+                self._parse(entry)
+                changed = True
+            dirs[rel] = entry
+            if self.recursive:
+                todo.extend(os.path.join(rel, x) for x in entry['dirs'][::-1])
+        changed |= dirs.keys() != self._dirs.keys()
+        self._dirs = dirs
+
+        order = sorted(dirs)
+        paths = [os.path.join(self.folder, rel, name) for rel in order for name in dirs[rel]['files']]
+        self.paths = np.array(paths, str)
+        self.columns = {
+            _pattern_name(pattern): np.concatenate(
+                [dirs[rel]['values'][pattern] for rel in order] + [np.zeros(0)])
+            for pattern in self.patterns
+        }
+        if changed and self.sidecar is not None:
+            self._write_sidecar()
+
+
 def colours(values, cmap=None, minmax=None):
     # Check if matplotlib needs to be imported.
     # We only do this here, as this takes a bit of time, so it's silly to do this
@@ -161,17 +412,907 @@ def map_axes(data, **axes):
         print(s, [key for key in axes if len(axes[key])==s])
 
 
-def load(filename):
+# The native on-disk format is a container: large numpy arrays are written as raw,
+# aligned blocks (like the data part of a .npy file), and the rest of the object
+# is pickled into a small header at the end of the file, with the arrays replaced
+# by references to their blocks. This way the arrays can be memory-mapped instead
+# of being decompressed and unpickled in full.
+#
+# Every dataset is also pickled into its own block, so the header of a saved
+# datalist or datadict is just an index of the tree: the axes, cut and shape of
+# each leaf, and where to find it. This allows loading trees lazily.
+#
+# Optionally, arrays can be compressed. They're then split into chunks along
+# their first axis, and each chunk is compressed separately in a thread pool.
+#
+# Layout: magic | array and dataset blocks | header pickle | header length (uint64) | magic
+_NATIVE_MAGIC = b"\x93DSUITE1"
+_NATIVE_ALIGN = 64
+# Arrays smaller than this (like most axes) are simply kept in the pickles
+_NATIVE_INLINE_BYTES = 1024
+# The approximate size of a compressed chunk before compression
+_NATIVE_CHUNK_BYTES = 1 << 22
+
+
+def _lz4_compress(data, level):
+    import lz4.frame
+    return lz4.frame.compress(data, compression_level=level)
+
+
+def _lz4_decompress(data):
+    import lz4.frame
+    return lz4.frame.decompress(data)
+
+
+def _zstd_compress(data, level):
+    import zstandard
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_decompress(data):
+    import zstandard
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+# Compression codecs for the native format, as (compress(data, level), decompress(data),
+# module needed or None). zlib and lzma release the GIL, so they scale with threads.
+# lz4 and zstd are optional, and can only be used if installed. More can be added here.
+compression_codecs = {
+    'zlib': (zlib.compress, zlib.decompress, 'zlib'),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 'lzma'),
+    'lz4': (_lz4_compress, _lz4_decompress, 'lz4'),
+    'zstd': (_zstd_compress, _zstd_decompress, 'zstandard'),
+}
+
+
+def _imap(func, items, workers=None, executor=ThreadPoolExecutor, ordered=True):
+    """
+    Like map, but runs func in a thread pool, yielding the results in order.
+    Only a few items are taken from items in advance, so memory use stays bounded.
+    With ordered=False, results are yielded as soon as they're ready instead.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        yield from map(func, items)
+        return
+    with executor(workers) as pool:
+        futures = deque() if ordered else set()
+        for item in items:
+            future = pool.submit(func, item)
+            if ordered:
+                futures.append(future)
+                if len(futures) >= 2*workers:
+                    yield futures.popleft().result()
+            else:
+                futures.add(future)
+                if len(futures) >= 2*workers:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+        if ordered:
+            while futures:
+                yield futures.popleft().result()
+        else:
+            while futures:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+
+def _rows(arr):
+    # The array as a C-contiguous 2D array of rows along the first axis
+    arr = np.ascontiguousarray(arr)
+    return arr.reshape((arr.shape[0] if arr.ndim else 1, -1))
+
+
+def _slab_rows(arr, chunk_size):
+    # How many rows along the first axis make a slab of about chunk_size bytes
+    return max(1, chunk_size // max(1, arr.nbytes // max(1, arr.shape[0] if arr.ndim else 1)))
+
+
+def _slabs(arr, step):
+    # Contiguous 2D slabs of step rows along the first axis of an array or ArrayBackend,
+    # read one at a time so that out-of-core data is never loaded in full
+    if not arr.ndim:
+        yield _rows(np.asarray(arr))
+        return
+    for i in range(0, arr.shape[0], step):
+        yield _rows(arr[i:i+step])
+
+
+class _NativePickler(pickle.Pickler):
+    """
+    Pickles an object into the header, writing large arrays and datasets
+    into the file as separate blocks.
+    """
+    def __init__(self, header, f, codec=None, level=6, chunk_size=_NATIVE_CHUNK_BYTES, workers=None,
+                 written=None, leaf=None):
+        super().__init__(header, protocol=pickle.HIGHEST_PROTOCOL)
+        self._f = f
+        self._codec = codec
+        self._level = level
+        self._chunk_size = chunk_size
+        self._workers = workers
+        # Blocks already written, so shared objects (like metadata) are stored once
+        self._written = {} if written is None else written
+        # The dataset being pickled into its own block, if any
+        self._leaf = leaf
+
+    def _write_block(self, data):
+        offset = self._f.tell()
+        padding = -offset % _NATIVE_ALIGN
+        self._f.write(b"\0" * padding)
+        self._f.write(data)
+        return offset + padding
+
+    def _write_array(self, arr):
+        step = _slab_rows(arr, self._chunk_size)
+        offset = None
+        for slab in _slabs(arr, step):
+            if offset is None:
+                offset = self._write_block(slab.data)
+            else:
+                self._f.write(slab.data)
+        return offset
+
+    def _write_chunks(self, arr):
+        step = _slab_rows(arr, self._chunk_size)
+        compress = compression_codecs[self._codec][0]
+        level = self._level
+        chunks = []
+        for data in _imap(lambda slab: compress(slab.data.cast('B'), level), _slabs(arr, step), self._workers):
+            chunks.append((self._write_block(data), len(data)))
+        return step, chunks
+
+    def persistent_id(self, obj):
+        if isinstance(obj, _lazy_dataset):
+            obj = obj.load()
+        if id(obj) in self._written:
+            return self._written[id(obj)][1]
+
+        if isinstance(obj, dataset) and obj is not self._leaf:
+            block = io.BytesIO()
+            _NativePickler(block, self._f, self._codec, self._level, self._chunk_size, self._workers,
+                           self._written, obj).dump(obj)
+            offset = self._write_block(block.getbuffer())
+            index = {'axes': obj.axes, 'cut': obj.cut, 'shape': obj.raw.shape}
+            pid = ('dataset', offset, block.tell(), index)
+        elif (isinstance(obj, (np.ndarray, ArrayBackend)) and not obj.dtype.hasobject
+                and obj.nbytes >= _NATIVE_INLINE_BYTES):
+            descr = np.lib.format.dtype_to_descr(obj.dtype)
+            if self._codec is None:
+                offset = self._write_array(obj)
+                pid = ('array', offset, descr, obj.shape)
+            else:
+                step, chunks = self._write_chunks(obj)
+                pid = ('chunked', self._codec, descr, obj.shape, step, chunks)
+        else:
+            return None
+        self._written[id(obj)] = obj, pid
+        return pid
+
+
+class _NativeUnpickler(pickle.Unpickler):
+    """
+    Reads the header of a native file, mapping or reading the arrays it refers to.
+    With lazy=True, datasets are not read, but replaced with _lazy_dataset stand-ins.
+    """
+    def __init__(self, header, f, mmap=False, lazy=False, workers=None):
+        super().__init__(header)
+        self._f = f
+        self._mmap = mmap
+        self._lazy = lazy
+        self._workers = workers
+
+    def _read_chunks(self, codec, dtype, shape, step, chunks):
+        out = np.empty(shape, dtype)
+        rows = _rows(out)
+        decompress = compression_codecs[codec][1]
+
+        def read():
+            # Reading happens here, decompression in the thread pool
+            for i, (offset, length) in enumerate(chunks):
+                self._f.seek(offset)
+                yield rows[i*step:(i+1)*step], self._f.read(length)
+
+        def unpack(item):
+            slab, data = item
+            slab.reshape(-1).view(np.uint8)[:] = np.frombuffer(decompress(data), np.uint8)
+
+        for _ in _imap(unpack, read(), self._workers):
+            pass
+        _count(bytes_read=sum(length for offset, length in chunks), bytes_decompressed=out.nbytes)
+        return out
+
+    def persistent_load(self, pid):
+        if pid[0] == 'dataset':
+            kind, offset, length, index = pid
+            if self._lazy:
+                return _lazy_dataset(self._f.name, offset, length, index, self._mmap, self._workers)
+            return _load_native_dataset(self._f, offset, length, self._mmap, self._workers)
+        if pid[0] == 'chunked':
+            kind, codec, descr, shape, step, chunks = pid
+            dtype = np.lib.format.descr_to_dtype(descr)
+            if self._mmap:
+                # Compressed arrays can't be memory-mapped, so they're read on demand instead
+                return ChunkedArray(self._f.name, codec, dtype, shape, step, chunks)
+            return self._read_chunks(codec, dtype, shape, step, chunks)
+
+        kind, offset, descr, shape = pid
+        dtype = np.lib.format.descr_to_dtype(descr)
+        if self._mmap:
+            return np.memmap(self._f.name, dtype=dtype, mode=self._mmap, offset=offset, shape=shape)
+        count = int(np.prod(shape))
+        self._f.seek(offset)
+        arr = np.fromfile(self._f, dtype=dtype, count=count).reshape(shape)
+        _count(bytes_read=arr.nbytes)
+        return arr
+
+
+def _load_native_dataset(f, offset, length, mmap=False, workers=None):
+    f.seek(offset)
+    _count(bytes_read=length)
+    return _NativeUnpickler(io.BytesIO(f.read(length)), f, mmap, workers=workers).load()
+
+
+class _lazy_dataset:
+    """
+    Stands in for a dataset in a lazily loaded datalist or datadict, until it's
+    first accessed. Only the index information (axes, cut and shape) is available
+    before that.
+    """
+    def __init__(self, filename, offset, length, index, mmap=False, workers=None):
+        self._filename = filename
+        self._offset = offset
+        self._length = length
+        self._axes = index['axes']
+        self._cut = index['cut']
+        self.shape = index['shape']
+        self._mmap = mmap
+        self._workers = workers
+
+    def load(self):
+        with open(self._filename, 'rb') as f:
+            new_data = _load_native_dataset(f, self._offset, self._length, self._mmap, self._workers)
+        # Cuts may have been added since loading the index
+        new_data._cut = self._cut
+        return new_data
+
+    @property
+    def axes(self):
+        return self._axes
+
+    @property
+    def cut(self):
+        return self._cut
+
+    def add_cut(self, key, value):
+        self._cut[key] = value
+
+    def __reduce_ex__(self, protocol):
+        # Pickled as the dataset it stands in for, so saving a lazily loaded tree keeps the data
+        new_data = self.load()
+        return object.__new__, (type(new_data),), new_data.__getstate__()
+
+    def __repr__(self):
+        return "dataset({})".format(", ".join("{}[{}]".format(key, n) for key, n in zip(self._axes, self.shape)))
+
+
+def _save_native(obj, filename, codec=None, level=6, chunk_size=_NATIVE_CHUNK_BYTES, workers=None):
+    if codec == 'none':
+        codec = None
+    if codec is not None:
+        if codec not in compression_codecs:
+            raise ValueError("Unknown codec: {}".format(codec))
+        if compression_codecs[codec][2] is not None:
+            # Fail early if an optional codec is not installed
+            __import__(compression_codecs[codec][2])
+    with open(filename, 'wb') as f:
+        f.write(_NATIVE_MAGIC)
+        header = io.BytesIO()
+        _NativePickler(header, f, codec, level, chunk_size, workers).dump(obj)
+        f.write(header.getbuffer())
+        f.write(struct.pack("<Q", header.tell()))
+        f.write(_NATIVE_MAGIC)
+
+
+def _load_native(f, mmap=False, lazy=False, workers=None):
+    f.seek(-8-len(_NATIVE_MAGIC), os.SEEK_END)
+    length, = struct.unpack("<Q", f.read(8))
+    if f.read(len(_NATIVE_MAGIC)) != _NATIVE_MAGIC:
+        raise ValueError("Truncated or corrupted file: {}".format(f.name))
+    f.seek(-8-len(_NATIVE_MAGIC)-length, os.SEEK_END)
+    header = io.BytesIO(f.read(length))
+    _count(bytes_read=length)
+    obj = _NativeUnpickler(header, f, mmap, lazy, workers).load()
+    if isinstance(obj, _lazy_dataset):
+        # There's no point in being lazy about a single dataset
+        obj = _load_native_dataset(f, obj._offset, obj._length, mmap, workers)
+    return obj
+
+
+class _members:
+    """
+    The header of a native file saved with format='members'. Each top-level key or
+    metadata entry is pickled and compressed into its own block, so single fields
+    can be read without touching the rest. 'index' maps member keys - ('item', key),
+    ('metadata', key) or ('shell',) - to (offset, length).
+    """
+    def __init__(self, codec, index):
+        self.codec = codec
+        self.index = index
+
+
+def _split_members(obj):
+    # The shell is what's left of obj once the members are taken out
+    if type(obj) is dict:
+        return None, {('item', key): value for key, value in obj.items()}
+    members = {('metadata', key): value for key, value in obj.metadata.items()}
+    if isinstance(obj, datalist):
+        # Read any lazily loaded datasets, so they're not pickled as stand-ins
+        obj.datasets
+    shell = copy.copy(obj)
+    shell.metadata = {}
+    if isinstance(obj, datadict):
+        members.update({('item', key): obj[key] for key in obj})
+        shell._dict = {}
+    members[('shell',)] = shell
+    return shell, members
+
+
+def _save_members(obj, filename, codec=None, level=6, workers=None):
+    if codec is None or codec == 'none':
+        codec = 'zlib'
+    if codec not in compression_codecs:
+        raise ValueError("Unknown codec: {}".format(codec))
+    compress = compression_codecs[codec][0]
+    shell, members = _split_members(obj)
+
+    def pack(key):
+        return key, compress(pickle.dumps(members[key], protocol=pickle.HIGHEST_PROTOCOL), level)
+
+    index = {}
+    with open(filename, 'wb') as f:
+        f.write(_NATIVE_MAGIC)
+        for key, data in _imap(pack, list(members), workers):
+            offset = f.tell()
+            padding = -offset % _NATIVE_ALIGN
+            f.write(b"\0" * padding)
+            f.write(data)
+            index[key] = offset + padding, len(data)
+        header = pickle.dumps(_members(codec, index), protocol=pickle.HIGHEST_PROTOCOL)
+        f.write(header)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(_NATIVE_MAGIC)
+
+
+def _read_member(f, header, key):
+    offset, length = header.index[key]
+    f.seek(offset)
+    data = compression_codecs[header.codec][1](f.read(length))
+    _count(bytes_read=length, bytes_decompressed=len(data))
+    return pickle.loads(data)
+
+
+def _load_members(f, header, fields=None):
+    if fields is not None:
+        keys = []
+        for field in fields:
+            if ('item', field) in header.index:
+                keys.append(('item', field))
+            elif ('metadata', field) in header.index:
+                keys.append(('metadata', field))
+            else:
+                raise KeyError(field)
+        return {key[1]: _read_member(f, header, key) for key in keys}
+
+    values = {key: _read_member(f, header, key) for key in header.index}
+    if ('shell',) not in values:
+        return {key[1]: value for key, value in values.items()}
+    obj = values.pop(('shell',))
+    for (kind, key), value in values.items():
+        if kind == 'metadata':
+            obj.metadata[key] = value
+        else:
+            obj._dict[key] = value
+    return obj
+
+
+def _select_fields(obj, fields):
+    # The fallback for files not saved with format='members'
+    selected = {}
+    for field in fields:
+        if type(obj) is dict or (isinstance(obj, datadict) and field in obj):
+            selected[field] = obj[field]
+        elif type(obj) is not dict and field in obj.metadata:
+            selected[field] = obj.metadata[field]
+        else:
+            raise KeyError(field)
+    return selected
+
+
+def _save(obj, filename, compress=6, format='pickle', codec=None, chunk_size=_NATIVE_CHUNK_BYTES,
+          workers=None):
+    if format == 'pickle':
+        with gzip.open(filename, 'wb', compresslevel=compress) as f:
+            pickle.dump(obj, f)
+    elif format == 'native':
+        _save_native(obj, filename, codec, compress, chunk_size, workers)
+    elif format == 'members':
+        _save_members(obj, filename, codec, compress, workers)
+    else:
+        raise ValueError("Unknown file format: {}".format(format))
+
+
+def save(obj, filename, compress=6, format='pickle', codec=None, chunk_size=_NATIVE_CHUNK_BYTES,
+         workers=None):
+    """
+    Save a dataset, datalist, datadict or a plain dict (like run metadata) to a file.
+    The arguments are as for dataset.save.
+    """
+    _save(obj, filename, compress, format, codec, chunk_size, workers)
+
+
+def load(filename, mmap=False, lazy=False, workers=None, fields=None):
+    """
+    Load a dataset, datalist or datadict from a file. Both the gzip-compressed pickle
+    files and the native format are recognised automatically.
+
+    For native files, pass mmap=True to memory-map the arrays instead of reading them,
+    which makes opening even huge files almost instant. The maps are read-only, so
+    the data can't be changed by accident; to change it, pass mmap='c' (copy-on-write,
+    never touching the file) or mmap='r+' (writing to the file) instead of True.
+    For calculations, like subtracting a background, see DatasetExpression.lazy.
+    Arrays saved with a compression codec can't be mapped, so they're loaded as
+    ChunkedArrays instead, which read and decompress chunks only when needed.
+
+    Pass lazy=True to only read the index of a native datalist or datadict. The
+    datasets in the tree are then read from the file when first accessed.
+
+    Compressed native arrays are decompressed in parallel with 'workers' threads,
+    one per CPU core by default.
+
+    mmap, lazy and workers are ignored for gzip-compressed files.
+
+    Pass a list of fields to only get those top-level keys or metadata entries, as a
+    dict. Files saved with format='members' then only read the fields asked for,
+    other files are loaded whole first.
+    """
+    if mmap is True:
+        mmap = 'r'
+    with open(filename, 'rb') as f:
+        if f.read(len(_NATIVE_MAGIC)) == _NATIVE_MAGIC:
+            obj = _load_native(f, mmap, lazy, workers)
+            if isinstance(obj, _members):
+                return _load_members(f, obj, fields)
+            return obj if fields is None else _select_fields(obj, fields)
     with gzip.open(filename, 'rb') as f:
-        return pickle.load(f)
+        obj = pickle.load(f)
+        _count(bytes_read=f.fileobj.tell(), bytes_decompressed=f.tell())
+    return obj if fields is None else _select_fields(obj, fields)
 
-        
-class dataset():
+
+class LoadError(Exception):
+    """
+    Stands in for a file that load_many couldn't load. The original exception is
+    kept as 'error'.
+    """
+    def __init__(self, path, error):
+        super().__init__("{}: {!r}".format(path, error))
+        self.path = path
+        self.error = error
+
+    def __reduce__(self):
+        return LoadError, (self.path, self.error)
+
+
+def _load_one(loader, kwargs, item):
+    i, path = item
+    try:
+        return i, path, loader(path, **kwargs)
+    except Exception as e:
+        return i, path, LoadError(path, e)
+
+
+def load_many(paths, workers=None, backend='thread', stream=False, loader=None, **kwargs):
+    """
+    Load many files in parallel, with 'workers' threads or processes (one per CPU core
+    by default). 'backend' is 'thread' or 'process' - processes sidestep the GIL when
+    unpickling lots of small files, threads avoid copying the results between processes.
+    Any extra keyword arguments are passed on to 'loader', which is load by default
+    (and must be picklable for the process backend).
+
+    Returns a list of the results in the order of 'paths'. Pass stream=True to get an
+    iterator of (path, result) pairs in the order the files finish loading instead.
+    Only a few files are in flight at a time, so streaming keeps memory use bounded.
+
+    A file that fails to load doesn't stop the others - its result is a LoadError.
+    """
+    executors = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}
+    if backend not in executors:
+        raise ValueError("Unknown backend: {}".format(backend))
+    paths = list(paths)
+    func = functools.partial(_load_one, loader or load, kwargs)
+    results = _imap(func, enumerate(paths), workers, executors[backend], ordered=False)
+    if stream:
+        return ((path, result) for i, path, result in results)
+    ordered = [None] * len(paths)
+    for i, path, result in results:
+        ordered[i] = result
+    return ordered
+
+
+def _full_index(index, ndim):
+    # Normalise an index into a tuple with an integer or a slice for every dimension
+    if not isinstance(index, tuple):
+        index = (index,)
+    if Ellipsis in index:
+        i = index.index(Ellipsis)
+        index = index[:i] + (slice(None),) * (ndim - len(index) + 1) + index[i+1:]
+    if len(index) > ndim:
+        raise IndexError("Too many indices for an array with {} dimensions".format(ndim))
+    for i in index:
+        if not isinstance(i, (int, np.integer, slice)):
+            raise IndexError("Only integers and slices can be used to index this array")
+    return index + (slice(None),) * (ndim - len(index))
+
+
+class ArrayBackend:
+    """
+    Base class for array-like objects that can be used as the data of a dataset in
+    place of a numpy array, for data that does not fit in memory, like ChunkedArray.
+
+    Subclasses need shape and dtype attributes, and a _get method that returns a
+    numpy array given a tuple with an integer or a slice for every dimension.
+    Indexing with integers and slices then reads just the needed part of the data,
+    while anything else (like numpy functions) reads all of it.
+    """
+    def __getitem__(self, index):
+        return self._get(_full_index(index, self.ndim))
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[()]
+        return data if dtype is None else data.astype(dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __reduce__(self):
+        # Pickling reads all the data
+        return np.asarray, (np.asarray(self),)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def astype(self, dtype):
+        """The data converted to dtype, lazily, as the parts that are accessed are read."""
+        return _converted_array(self, dtype)
+
+
+class ChunkCache:
+    """
+    A least recently used cache for chunks of data read from disk, which
+    keeps their total size under max_bytes.
+    """
+    def __init__(self, max_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self._chunks = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, read):
+        """
+        Return the chunk for the given key, calling read() to get it if it's not cached.
+        """
+        with self._lock:
+            if key in self._chunks:
+                self._chunks.move_to_end(key)
+                return self._chunks[key]
+        chunk = read()
+        with self._lock:
+            if key not in self._chunks:
+                self._chunks[key] = chunk
+                self._nbytes += chunk.nbytes
+            while self._nbytes > self.max_bytes and len(self._chunks) > 1:
+                self._nbytes -= self._chunks.popitem(last=False)[1].nbytes
+        return chunk
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+
+# The cache used by all ChunkedArrays. Set chunk_cache.max_bytes to change the memory budget.
+chunk_cache = ChunkCache()
+
+
+class ChunkedArray(ArrayBackend):
+    """
+    Data stored in compressed chunks along the first axis of a native file (see
+    dataset.save), loaded by load(filename, mmap=True). Chunks are only read and
+    decompressed when needed, and kept in chunk_cache.
+    """
+    def __init__(self, filename, codec, dtype, shape, chunk_rows, chunks):
+        self._filename = os.path.abspath(filename)
+        # Including the modification time means stale chunks are not used if the file changes
+        self._key = self._filename, os.path.getmtime(filename)
+        self._codec = codec
+        self.dtype = dtype
+        self.shape = tuple(shape)
+        self.chunk_rows = chunk_rows
+        self._chunks = chunks
+
+    def _read_chunk(self, k):
+        offset, length = self._chunks[k]
+        with open(self._filename, 'rb') as f:
+            f.seek(offset)
+            data = compression_codecs[self._codec][1](f.read(length))
+        _count(bytes_read=length, bytes_decompressed=len(data))
+        if not self.shape:
+            return np.frombuffer(data, self.dtype).reshape(())
+        rows = min(self.chunk_rows, self.shape[0] - k*self.chunk_rows)
+        return np.frombuffer(data, self.dtype).reshape((rows,) + self.shape[1:])
+
+    def chunk(self, k):
+        """
+        The k-th chunk of rows along the first axis, read-only.
+        """
+        return chunk_cache.get(self._key + (self._chunks[k][0],), lambda: self._read_chunk(k))
+
+    def _get(self, index):
+        if not self.shape:
+            return np.array(self.chunk(0))
+        first, rest = index[0], index[1:]
+        n = self.shape[0]
+        rows = range(n)[first]
+        if not isinstance(first, slice):
+            rows = range(rows, rows+1)
+        # Go through the runs of rows that fall into the same chunk
+        pieces = []
+        j = 0
+        while j < len(rows):
+            k = rows[j] // self.chunk_rows
+            low, high = k * self.chunk_rows, min((k+1) * self.chunk_rows, n)
+            if rows.step > 0:
+                count = len(range(rows[j], min(rows.stop, high), rows.step))
+            else:
+                count = len(range(rows[j], max(rows.stop, low-1), rows.step))
+            run = rows[j:j+count]
+            local = slice(run.start - low, run.stop - low if run.stop - low >= 0 else None, run.step)
+            pieces.append(self.chunk(k)[(local,) + rest])
+            j += count
+        if not pieces:
+            return np.empty((0,) + self.shape[1:], self.dtype)[(slice(None),) + rest]
+        data = np.concatenate(pieces)
+        return data if isinstance(first, slice) else data[0]
+
+
+class _expanded_array(ArrayBackend):
+    # An ArrayBackend with a new first axis of length 1, for dataset.expand
+    def __init__(self, base):
+        self._base = base
+        self.shape = (1,) + base.shape
+        self.dtype = base.dtype
+
+    def _get(self, index):
+        return np.expand_dims(self._base[index[1:]], 0)[index[0]]
+
+
+class _converted_array(ArrayBackend):
+    # An ArrayBackend converted to another dtype, for ArrayBackend.astype
+    def __init__(self, base, dtype):
+        self._base = base
+        self.shape = base.shape
+        self.dtype = np.dtype(dtype)
+
+    def _get(self, index):
+        return self._base[index].astype(self.dtype)
+
+
+class _expression_array(ArrayBackend):
+    # The result of a DatasetExpression, evaluated only for the parts that are accessed
+    def __init__(self, expression):
+        self._expression = expression
+        self.shape = tuple(len(expression.axis(key)) for key in expression.axes)
+        self.dtype = np.result_type(expression._evaluate_index(
+            expression.axes, {key: slice(0, 1) for key in expression.axes}))
+
+    def _get(self, index):
+        axes = self._expression.axes
+        ranges = {}
+        for key, i, n in zip(axes, index, self.shape):
+            if not isinstance(i, slice):
+                i = range(n)[i]
+                i = slice(i, i+1)
+            ranges[key] = i
+        result = self._expression._evaluate_index(axes, ranges)
+        shape = tuple(len(range(n)[ranges[key]]) for key, n in zip(axes, self.shape))
+        result = np.broadcast_to(result, shape)
+        return np.array(result[tuple(i if isinstance(i, slice) else 0 for i in index)])
+
+
+# Reductions that can be done one chunk at a time along the first axis, and combined after
+_chunked_reductions = ('sum', 'nansum', 'max', 'min', 'nanmax', 'nanmin')
+
+
+def _reduce_chunked(raw, op, indices):
+    # Reduce an ArrayBackend one slab of rows at a time
+    if not raw.ndim:
+        return reductions[op](np.asarray(raw))
+    step = getattr(raw, 'chunk_rows', None) or _slab_rows(raw, _NATIVE_CHUNK_BYTES)
+    slabs = (np.asarray(raw[i:i+step]) for i in range(0, raw.shape[0], step))
+    if 0 not in np.atleast_1d(indices):
+        return np.concatenate([reductions[op](slab, axis=indices) for slab in slabs])
+    if op in _chunked_reductions:
+        return reductions[op]([reductions[op](slab, axis=indices) for slab in slabs], axis=0)
+    if op == 'mean':
+        count = int(np.prod([raw.shape[i] for i in np.atleast_1d(indices)]))
+        return np.sum([np.sum(slab, axis=indices) for slab in slabs], axis=0) / count
+    # Anything else needs all the data along the first axis at once
+    return reductions[op](np.asarray(raw), axis=indices)
+
+
+class _arithmetic:
+    """
+    Arithmetic for datasets, views and expressions. Operators and numpy ufuncs
+    (like np.log) don't compute anything, but build a lazy DatasetExpression.
+    """
+    __slots__ = ()
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method != '__call__' or ufunc.nout != 1 or 'out' in kwargs:
+            return NotImplemented
+        return DatasetExpression(ufunc, inputs, **kwargs)
+
+    def __add__(self, other):
+        return DatasetExpression(np.add, (self, other))
+
+    def __radd__(self, other):
+        return DatasetExpression(np.add, (other, self))
+
+    def __sub__(self, other):
+        return DatasetExpression(np.subtract, (self, other))
+
+    def __rsub__(self, other):
+        return DatasetExpression(np.subtract, (other, self))
+
+    def __mul__(self, other):
+        return DatasetExpression(np.multiply, (self, other))
+
+    def __rmul__(self, other):
+        return DatasetExpression(np.multiply, (other, self))
+
+    def __truediv__(self, other):
+        return DatasetExpression(np.true_divide, (self, other))
+
+    def __rtruediv__(self, other):
+        return DatasetExpression(np.true_divide, (other, self))
+
+    def __pow__(self, other):
+        return DatasetExpression(np.power, (self, other))
+
+    def __rpow__(self, other):
+        return DatasetExpression(np.power, (other, self))
+
+    def __neg__(self):
+        return DatasetExpression(np.negative, (self,))
+
+    def __abs__(self):
+        return DatasetExpression(np.absolute, (self,))
+
+
+# Operations available for dataset.reduce
+reductions = {
+    'sum': np.sum,
+    'mean': np.mean,
+    'max': np.amax,
+    'min': np.amin,
+    'std': np.std,
+    'argmax': np.argmax,
+    'argmin': np.argmin,
+    'nansum': np.nansum,
+    'nanmean': np.nanmean,
+    'nanmax': np.nanmax,
+    'nanmin': np.nanmin,
+    'nanstd': np.nanstd,
+    'nanargmax': np.nanargmax,
+    'nanargmin': np.nanargmin,
+}
+
+
+# Resampling weights for recently used (source grid, target grid, method) combinations
+_resample_cache = OrderedDict()
+_resample_cache_size = 64
+_resample_lock = threading.Lock()
+
+
+def _resample_weights(source, target, method):
+    """
+    Work out how to resample data from one grid onto another, as (indices, weights,
+    valid). The new value at target[j] is the sum of data[indices[j]] * weights[j],
+    or data @ weights.T if indices is None (cubic). 'valid' marks the target points
+    within the source grid.
+    """
+    source = np.asarray(source)
+    target = np.asarray(target)
+    key = method, source.dtype.str, source.tobytes(), target.dtype.str, target.tobytes()
+    with _resample_lock:
+        if key in _resample_cache:
+            _resample_cache.move_to_end(key)
+            return _resample_cache[key]
+
+    order = np.argsort(source, kind='stable')
+    s = source[order].astype(np.float64)
+    t = target.astype(np.float64)
+    n = len(s)
+    valid = (t >= s[0]) & (t <= s[-1])
+    if n == 1:
+        indices, weights = np.zeros((len(t), 1), np.intp), np.ones((len(t), 1))
+    elif method == 'nearest':
+        i = np.clip(np.searchsorted(s, t), 1, n-1)
+        i -= t - s[i-1] <= s[i] - t
+        indices, weights = order[i][:, None], np.ones((len(t), 1))
+    elif method == 'linear':
+        i = np.clip(np.searchsorted(s, t, 'right'), 1, n-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            right = np.nan_to_num((t - s[i-1]) / (s[i] - s[i-1]))
+        indices = np.stack((order[i-1], order[i]), 1)
+        weights = np.stack((1 - right, right), 1)
+    elif method == 'cubic':
+        from scipy.interpolate import CubicSpline
+        indices = None
+        weights = np.zeros((len(t), n))
+        weights[:, order] = CubicSpline(s, np.eye(n), axis=0)(t)
+    else:
+        raise ValueError("Unknown resampling method: {}".format(method))
+
+    result = indices, weights, valid
+    with _resample_lock:
+        _resample_cache[key] = result
+        while len(_resample_cache) > _resample_cache_size:
+            _resample_cache.popitem(last=False)
+    return result
+
+
+def _resample(raw, dim, source, target, method='linear', fill=np.nan):
+    indices, weights, valid = _resample_weights(source, target, method)
+    raw = np.moveaxis(np.asarray(raw), dim, -1)
+    if indices is None:
+        out = raw @ weights.T
+    elif indices.shape[1] == 1:
+        out = raw[..., indices[:, 0]]
+    else:
+        # All the rows at once, as a weighted sum of gathered columns
+        out = raw[..., indices[:, 0]] * weights[:, 0]
+        for j in range(1, indices.shape[1]):
+            out += raw[..., indices[:, j]] * weights[:, j]
+    if not valid.all():
+        out = out.astype(np.result_type(out, np.min_scalar_type(fill)), copy=False)
+        out[..., ~valid] = fill
+    return np.moveaxis(out, -1, dim)
+
+
+class dataset(_arithmetic):
     """
     A container for data with labelled axes.
     """
     def __init__(self, data, cut=None, **axes):
-        self._raw = np.asarray(data)
+        self._raw = data if isinstance(data, ArrayBackend) else np.asarray(data)
         if len(axes) != self._raw.ndim:
             raise IndexError("The number of provided axes does not match the dataset.")
         for i, key in enumerate(axes):
@@ -185,20 +1326,32 @@ class dataset():
         self.metadata = {}
         
     def take(self, **i):
-        s_raw = self._raw
+        s_raw = self.take_raw(**i)
         cut = self._cut
         new_axes = self.ax_dict
-        new_ax_names = self.axes.copy()
         for key in i:
-            s_raw = np.moveaxis(s_raw, new_ax_names.index(key), 0)[i[key]]
             cut[key] = self.axis(key)[i[key]]
             new_axes.pop(key)
-            new_ax_names.remove(key)
         new_data = dataset(s_raw, cut=cut, **new_axes)
         new_data.metadata = self.metadata
         return new_data
     
     def take_raw(self, **i):
+        if all(isinstance(value, (int, np.integer, slice)) for value in i.values()):
+            # Integers and slices are applied all at once, so that only the needed
+            # part of the data is read if it's on disk
+            index = [slice(None)] * len(self._axes)
+            for key in i:
+                index[self._axes.index(key)] = i[key]
+            s_raw = self._raw[tuple(index)]
+            # Axes taken with a slice are moved to the front, as below
+            new_ax_names = [key for key, j in zip(self._axes, index) if isinstance(j, slice)]
+            for key in i:
+                if isinstance(i[key], slice):
+                    s_raw = np.moveaxis(s_raw, new_ax_names.index(key), 0)
+                    new_ax_names.remove(key)
+                    new_ax_names.insert(0, key)
+            return s_raw
         s_raw = self._raw
         new_ax_names = self.axes.copy()
         for key in i:
@@ -206,14 +1359,201 @@ class dataset():
             new_ax_names.remove(key)
         return s_raw
     
+    def _lookup(self, key):
+        # Sorted values of an axis for binary search, the indices sorting it (None if
+        # the axis is increasing already), and whether the axis is monotonic.
+        # Cached until the axis is replaced.
+        values = self.axis(key)
+        lookups = self.__dict__.setdefault('_lookups', {})
+        if key in lookups and lookups[key][0] is values:
+            return lookups[key][1:]
+        diff = np.diff(values)
+        monotonic = True
+        if np.all(diff >= 0):
+            order = None
+        elif np.all(diff <= 0):
+            order = np.arange(len(values))[::-1]
+        else:
+            order = np.argsort(values, kind='stable')
+            monotonic = False
+        sorted_values = values if order is None else values[order]
+        lookups[key] = values, sorted_values, order, monotonic
+        return sorted_values, order, monotonic
+
+    def find_index(self, axis, value, method='nearest'):
+        """
+        Find the index of a value along an axis, using a binary search. value can
+        also be an array of values, in which case an array of indices is returned.
+
+        method is one of:
+            'nearest': the index of the closest value
+            'pad': the index of the largest value <= value
+            'backfill': the index of the smallest value >= value
+        A KeyError is raised if there is no such value for 'pad' or 'backfill'.
+        """
+        sorted_values, order, monotonic = self._lookup(axis)
+        value = np.asarray(value)
+        n = len(sorted_values)
+        if method == 'nearest':
+            i = np.clip(np.searchsorted(sorted_values, value), 1, max(n-1, 1))
+            i = np.where(np.abs(value - sorted_values[i-1]) <= np.abs(sorted_values[np.minimum(i, n-1)] - value),
+                         i-1, np.minimum(i, n-1))
+        elif method == 'pad':
+            i = np.searchsorted(sorted_values, value, 'right') - 1
+            if np.any(i < 0):
+                raise KeyError("No '{}' value <= {}".format(axis, value))
+        elif method == 'backfill':
+            i = np.searchsorted(sorted_values, value, 'left')
+            if np.any(i >= n):
+                raise KeyError("No '{}' value >= {}".format(axis, value))
+        else:
+            raise ValueError("Unknown method: {}".format(method))
+        if order is not None:
+            i = order[i]
+        return int(i) if i.ndim == 0 else i
+
+    def _sel_index(self, key, value, method):
+        # Convert a label-based selection into an index for the given axis
+        if not isinstance(value, slice):
+            return self.find_index(key, value, method)
+        sorted_values, order, monotonic = self._lookup(key)
+        n = len(sorted_values)
+        first, last = value.start, value.stop
+        if first is not None and last is not None and (first > last) == (order is None):
+            # Both bounds are given, so they can be put in the order of the axis
+            first, last = last, first
+        if order is None:
+            start = 0 if first is None else np.searchsorted(sorted_values, first, 'left')
+            stop = n if last is None else np.searchsorted(sorted_values, last, 'right')
+            return slice(int(start), int(stop), value.step)
+        if monotonic:
+            # Decreasing axis, where 'first' is the high end of the range
+            start = 0 if first is None else n - np.searchsorted(sorted_values, first, 'right')
+            stop = n if last is None else n - np.searchsorted(sorted_values, last, 'left')
+            return slice(int(start), int(stop), value.step)
+        raise ValueError("Axis '{}' must be monotonic to select a range".format(key))
+
+    def _sel(self, method, i):
+        # The selected raw data, the remaining axes and the selected cut values
+        index = [slice(None)] * self._raw.ndim
+        arrays = {}
+        new_axes = self.ax_dict
+        cut = {}
+        for key in i:
+            ax_i = self._axes.index(key)
+            index[ax_i] = self._sel_index(key, i[key], method)
+            if isinstance(index[ax_i], slice):
+                new_axes[key] = new_axes[key][index[ax_i]]
+            elif np.ndim(index[ax_i]):
+                # Arrays are applied separately, as numpy would broadcast them together
+                arrays[ax_i] = index[ax_i]
+                index[ax_i] = slice(None)
+                new_axes[key] = new_axes[key][arrays[ax_i]]
+            else:
+                cut[key] = new_axes.pop(key)[index[ax_i]]
+        s_raw = self._raw[tuple(index)]
+        # Adjust the positions of array-indexed axes for the ones removed
+        removed = [ax_i for ax_i, ind in enumerate(index) if not isinstance(ind, slice)]
+        for ax_i in arrays:
+            s_raw = np.take(s_raw, arrays[ax_i], axis=ax_i - sum(r < ax_i for r in removed))
+        return s_raw, new_axes, cut
+
+    def sel(self, method='nearest', **i):
+        """
+        Select data by axis values rather than indices, for example
+        data.sel(wl=slice(850, 870), power=0.3).
+        A slice selects an inclusive range of values on a monotonic axis, with its
+        bounds in either order, so it works the same on a decreasing axis (a missing
+        bound stands for the start or end of the axis, as with indices), a single
+        value selects the matching index (according to method, see find_index) and
+        removes the axis, adding it to the cut, and an array of values selects
+        the corresponding indices.
+        The returned dataset is a view on this one, unless arrays of values are used.
+        """
+        s_raw, new_axes, cut = self._sel(method, i)
+        new_data = dataset(s_raw, cut={**self._cut, **cut}, **new_axes)
+        new_data.metadata = self.metadata
+        return new_data
+
+    def sel_raw(self, method='nearest', **i):
+        """
+        Like sel, but returns just the raw data.
+        """
+        return self._sel(method, i)[0]
+
+    def view(self, **i):
+        """
+        Return a lightweight DatasetView on this dataset, with the given indices taken.
+        """
+        new_view = DatasetView(self)
+        return new_view.take(**i) if i else new_view
+
     def take_sum(self, axis):
+        return self.reduce(axis, 'sum')
+
+    def reduce(self, axes, op='sum'):
+        """
+        Reduce the data along one or more axes (a name or a list of names) with one
+        of the operations in the reductions dictionary, like 'sum', 'max' or 'nanmean'.
+        The arg operations (like 'argmax') only work along a single axis.
+
+        The results are cached, so repeating a reduction only copies the (small) result.
+        The cache is cleared when _raw is replaced (including in-place operations like
+        data._raw -= bg), by data[...] = values and by evaluate(out=data), but call
+        clear_cache after modifying the raw array directly, like data.raw[0] = 0.
+        """
+        if isinstance(axes, str):
+            axes = [axes]
+        indices = tuple(sorted(self._axes.index(axis) for axis in axes))
+        reductions_cache = self.__dict__.setdefault('_reductions', {})
+        key = indices, op
+        if key not in reductions_cache:
+            if op.startswith(('arg', 'nanarg')):
+                if len(indices) > 1:
+                    raise ValueError("'{}' can only be used along a single axis".format(op))
+                indices = indices[0]
+            if isinstance(self._raw, ArrayBackend):
+                result = np.asarray(_reduce_chunked(self._raw, op, indices))
+            else:
+                result = np.asarray(reductions[op](self._raw, axis=indices))
+            result.flags.writeable = False
+            reductions_cache[key] = result
+        new_axes = {key: self.axis(key) for key in self._axes if key not in axes}
+        # A copy, so changing the result doesn't change the cache
+        new_data = dataset(reductions_cache[key].copy(), **new_axes)
+        new_data.metadata = self.metadata
+        return new_data
+
+    def resample(self, method='linear', fill=np.nan, **axes):
+        """
+        Interpolate the data onto new axis values, for example resample(wl=new_wls).
+        'method' is 'linear', 'nearest' or 'cubic' (needs scipy), and points outside
+        the original axis range are set to 'fill'.
+
+        The interpolation weights are worked out once for each pair of grids and cached,
+        then applied to all the data at once, so resampling many datasets from the same
+        grid is cheap.
+        """
+        raw = self._raw
         new_axes = self.ax_dict
-        new_axes.pop(axis)
-        new_data = dataset(np.sum(self._raw, axis=self._axes.index(axis)), **new_axes)
+        for key, values in axes.items():
+            values = np.asarray(values)
+            raw = _resample(raw, self._axes.index(key), new_axes[key], values, method, fill)
+            new_axes[key] = values
+        new_data = dataset(raw, cut=self._cut, **new_axes)
         new_data.metadata = self.metadata
         return new_data
+
+    def clear_cache(self):
+        """
+        Forget cached reductions, which is needed after modifying the data in place
+        without replacing _raw, like data.raw[0] = 0.
+        """
+        self.__dict__.pop('_reductions', None)
     
     def expand(self, new_axis, value):
+        if isinstance(self._raw, ArrayBackend):
+            return dataset(_expanded_array(self._raw), **{new_axis: [value], **self.ax_dict})
         return dataset(np.expand_dims(self._raw, axis=0),
                        **{new_axis: [value], **self.ax_dict})
     
@@ -223,6 +1563,17 @@ class dataset():
         return dataset(np.concatenate((self._raw, other.raw), axis=self._axes.index(axis)),
                       **new_axes)
     
+    @staticmethod
+    def concat(datasets, axis):
+        """
+        Join a list of datasets along an axis, like repeated join would, but copying
+        all the data only once.
+        """
+        new_axes = datasets[0].ax_dict
+        new_axes[axis] = np.concatenate([d.axis(axis) for d in datasets])
+        return dataset(np.concatenate([d.raw for d in datasets], axis=datasets[0].axes.index(axis)),
+                       **new_axes)
+
     def axis(self, ax):
         return getattr(self, ax)
     
@@ -231,9 +1582,23 @@ class dataset():
         new_data.metadata = self.metadata
         return new_data
 
-    def save(self, filename, compress=6):
-        with gzip.open(filename, 'wb', compresslevel=compress) as f:
-            pickle.dump(self, f)
+    def save(self, filename, compress=6, format='pickle', codec=None, chunk_size=_NATIVE_CHUNK_BYTES,
+             workers=None):
+        """
+        Save the dataset to a file. The default format is a gzip-compressed pickle,
+        compressed with the given level.
+
+        format='native' writes the native format instead, uncompressed by default,
+        which load can memory-map (see load). Its arrays can be compressed by passing
+        a codec: 'zlib', 'lzma', or 'lz4' and 'zstd' if those are installed ('none'
+        is the default), with compress as the level. The arrays are then split into
+        chunks of about chunk_size bytes, compressed by 'workers' threads at once,
+        one per CPU core by default.
+
+        format='members' compresses each metadata entry separately (with codec,
+        'zlib' by default), so load(filename, fields=[...]) can read just those.
+        """
+        _save(self, filename, compress, format, codec, chunk_size, workers)
     
     @property
     def raw(self):
@@ -254,10 +1619,350 @@ class dataset():
     def add_cut(self, key, value):
         self._cut[key] = value
     
+    def __setattr__(self, name, value):
+        if name == '_raw':
+            # Cached reductions are not valid for the new data
+            self.__dict__.pop('_reductions', None)
+        super().__setattr__(name, value)
+
+    def __setitem__(self, index, value):
+        # Writes to the data in place, so the cached reductions are no longer valid
+        self._raw[index] = value
+        self.clear_cache()
+
+    def __getstate__(self):
+        # The caches are not worth saving
+        state = self.__dict__.copy()
+        state.pop('_lookups', None)
+        state.pop('_reductions', None)
+        return state
+
     def __repr__(self):
         return "dataset({})".format(", ".join("{}[{}]".format(key, len(self.axis(key))) for key in self._axes))
 
 
+def _index_slice(r):
+    # Convert a range into the equivalent slice
+    return slice(r.start, r.stop if r.stop >= 0 else None, r.step)
+
+
+class DatasetView(_arithmetic):
+    """
+    A lightweight view on a dataset, for hot paths like updating plots on every
+    mouse move. It just records which indices have been taken (integers, or slices,
+    which keep the axis), so taking is very cheap and never copies any data.
+    The raw data is a numpy view on the original dataset, worked out when accessed.
+
+    Views don't have the full functionality of datasets, so use to_dataset to get
+    a proper dataset when needed.
+    """
+    __slots__ = ('_parent', '_index')
+
+    def __init__(self, parent, index=None):
+        self._parent = parent
+        self._index = (slice(None),) * len(parent.axes) if index is None else index
+
+    def take(self, **i):
+        index = list(self._index)
+        parent_axes = self._parent._axes
+        shape = self._parent._raw.shape
+        for key in i:
+            pos = parent_axes.index(key) if key in parent_axes else None
+            if pos is None or not isinstance(index[pos], slice):
+                raise KeyError("No axis '{}' in this view".format(key))
+            # Indexing a range composes the indices without touching any arrays
+            taken = range(shape[pos])[index[pos]][i[key]]
+            index[pos] = _index_slice(taken) if isinstance(taken, range) else taken
+        return DatasetView(self._parent, tuple(index))
+
+    def take_raw(self, **i):
+        return self.take(**i).raw
+
+    def to_dataset(self):
+        new_data = dataset(self.raw, cut=self.cut, **self.ax_dict)
+        new_data.metadata = self.metadata
+        return new_data
+
+    def axis(self, ax):
+        if ax not in self.axes:
+            raise KeyError("No axis '{}' in this view".format(ax))
+        return self._parent.axis(ax)[self._index[self._parent.axes.index(ax)]]
+
+    @property
+    def raw(self):
+        return self._parent._raw[self._index]
+
+    @property
+    def axes(self):
+        return [key for key, i in zip(self._parent.axes, self._index) if isinstance(i, slice)]
+
+    @property
+    def ax_dict(self):
+        return {key: self.axis(key) for key in self.axes}
+
+    @property
+    def cut(self):
+        cut = dict(self._parent.cut)
+        for key, i in zip(self._parent.axes, self._index):
+            if not isinstance(i, slice):
+                cut[key] = self._parent.axis(key)[i]
+        return cut
+
+    @property
+    def metadata(self):
+        return self._parent.metadata
+
+    def __getattr__(self, name):
+        # Axes are available as attributes, like for datasets
+        if not name.startswith('_') and name in self.axes:
+            return self.axis(name)
+        raise AttributeError("'DatasetView' object has no attribute '{}'".format(name))
+
+    def __repr__(self):
+        return "DatasetView({})".format(", ".join("{}[{}]".format(key, len(self.axis(key))) for key in self.axes))
+
+
+class _named_array:
+    """
+    A plain array used in an expression, with its dimensions named after the
+    trailing axes of the expression (so it broadcasts like in numpy).
+    """
+    __slots__ = ('raw', 'axes')
+
+    def __init__(self, raw, axes):
+        self.raw = raw
+        self.axes = axes
+
+
+class DatasetExpression(_arithmetic):
+    """
+    A lazily evaluated calculation on datasets, created by using operators or numpy
+    ufuncs on them, like (data - background) / time or np.log(data).
+
+    Datasets are broadcast against each other by axis name, so data(pos, y, wl)
+    minus background(wl) works whatever the axis order. Plain numpy arrays are
+    broadcast like in numpy, against the trailing axes.
+
+    Nothing is computed until evaluate is called. The calculation is then done
+    in chunks along one axis, so memory-mapped data is never loaded in full.
+    """
+    def __init__(self, func, operands, **kwargs):
+        self._func = func
+        self._kwargs = kwargs
+        self._ax_dict = {}
+        for operand in operands:
+            if isinstance(operand, (dataset, DatasetView, DatasetExpression)):
+                for key, values in operand.ax_dict.items():
+                    if key not in self._ax_dict:
+                        self._ax_dict[key] = values
+                    elif (len(values) != len(self._ax_dict[key])
+                            or not np.array_equal(values, self._ax_dict[key])):
+                        raise IndexError("The '{}' axes of the operands do not match.".format(key))
+        self._axes = list(self._ax_dict.keys())
+        self._operands = tuple(self._named(operand) for operand in operands)
+
+    def _named(self, operand):
+        # Name the dimensions of plain arrays after the trailing axes
+        if isinstance(operand, (dataset, DatasetView, DatasetExpression)) or not np.ndim(operand):
+            return operand
+        operand = np.asarray(operand)
+        if operand.ndim > len(self._axes):
+            raise IndexError("The array has more dimensions than the expression has axes.")
+        axes = self._axes[len(self._axes)-operand.ndim:]
+        for key, n in zip(axes, operand.shape):
+            if n not in (1, len(self._ax_dict[key])):
+                raise IndexError("The shape of the array does not match the '{}' axis.".format(key))
+        return _named_array(operand, axes)
+
+    def _evaluate_index(self, axes, index):
+        # Evaluate a part of the expression, given as a dictionary of slices for
+        # some of the axes. The result has the given axes, which may have
+        # length 1 where the operands don't depend on them.
+        values = []
+        for operand in self._operands:
+            if isinstance(operand, DatasetExpression):
+                values.append(operand._evaluate_index(axes, index))
+            elif isinstance(operand, (dataset, DatasetView, _named_array)):
+                op_axes = operand.axes
+                raw = operand.raw
+                if any(key in index for key in op_axes):
+                    # Only read the needed part of the data
+                    raw = raw[tuple(index.get(key, slice(None)) if n != 1 else slice(None)
+                                    for key, n in zip(op_axes, raw.shape))]
+                raw = np.transpose(raw, sorted(range(len(op_axes)), key=lambda j: axes.index(op_axes[j])))
+                missing = tuple(j for j, key in enumerate(axes) if key not in op_axes)
+                values.append(np.expand_dims(raw, missing) if missing else raw)
+            else:
+                values.append(operand)
+        return self._func(*values, **self._kwargs)
+
+    def evaluate(self, out=None, axis=None, chunk_size=_NATIVE_CHUNK_BYTES):
+        """
+        Compute the expression, in chunks of about chunk_size bytes along the given
+        axis (the longest one by default), and return the result as a dataset.
+
+        out can be an array (like a np.memmap) or a dataset to write the result
+        into, otherwise a new array is allocated. For an elementwise expression,
+        out can also be one of the datasets it uses, to calculate in place.
+        If out is a dataset backed by an ArrayBackend, its data is replaced by the
+        result, evaluated lazily whenever a part of it is accessed.
+        """
+        shape = tuple(len(self._ax_dict[key]) for key in self._axes)
+        if axis is None:
+            axis = self._axes[int(np.argmax(shape))] if shape else None
+        target = out.raw if isinstance(out, dataset) else out
+        if target is not None and target.shape != shape:
+            raise IndexError("The shape of out does not match the expression.")
+
+        if isinstance(target, ArrayBackend):
+            # Data on disk can't be written to, so it's replaced with the result, which is
+            # evaluated when accessed. A copy of the dataset keeps the original data for that.
+            out._raw = _expression_array(self._substitute(out, copy.copy(out)))
+            return out
+
+        if axis is None:
+            # No axes to chunk along, so just a single value
+            result = self._evaluate_index(self._axes, {})
+            if target is None:
+                target = np.array(result)
+            else:
+                target[()] = result
+        else:
+            ax_i = self._axes.index(axis)
+            # Assuming 8 bytes per element, as the dtype is not known in advance
+            step = max(1, chunk_size // max(1, 8 * int(np.prod(shape)) // max(1, shape[ax_i])))
+            for start in range(0, shape[ax_i], step):
+                chunk = slice(start, start+step)
+                result = self._evaluate_index(self._axes, {axis: chunk})
+                if target is None:
+                    target = np.empty(shape, np.result_type(result))
+                target[(slice(None),) * ax_i + (chunk,)] = result
+            if target is None:
+                target = np.empty(shape)
+
+        if out is not None:
+            # The data written to may belong to datasets in the expression, as well as to out
+            for x in list(self._datasets()) + [out]:
+                if isinstance(x, DatasetView):
+                    x = x._parent
+                if isinstance(x, dataset) and np.may_share_memory(x._raw, target):
+                    x.clear_cache()
+        if isinstance(out, dataset):
+            return out
+        new_data = dataset(target, **self._ax_dict)
+        first = next((x for x in self._datasets()), None)
+        if first is not None:
+            new_data.metadata = first.metadata
+        return new_data
+
+    def lazy(self):
+        """
+        The expression as a dataset whose data is only computed for the parts that
+        are accessed, like data.take_raw(pos=0) or a reduction (done in chunks).
+        Nothing is computed or copied up front, so memory-mapped data stays on disk.
+        """
+        new_data = dataset(_expression_array(self), **self._ax_dict)
+        first = next((x for x in self._datasets()), None)
+        if first is not None:
+            new_data.metadata = first.metadata
+        return new_data
+
+    def _substitute(self, old, new):
+        # A copy of the expression with the dataset old replaced by new
+        substituted = copy.copy(self)
+        operands = []
+        for operand in self._operands:
+            if operand is old:
+                operand = new
+            elif isinstance(operand, DatasetView) and operand._parent is old:
+                operand = DatasetView(new, operand._index)
+            elif isinstance(operand, DatasetExpression):
+                operand = operand._substitute(old, new)
+            operands.append(operand)
+        substituted._operands = tuple(operands)
+        return substituted
+
+    def _datasets(self):
+        # All the datasets and views used in the expression
+        for operand in self._operands:
+            if isinstance(operand, DatasetExpression):
+                yield from operand._datasets()
+            elif isinstance(operand, (dataset, DatasetView)):
+                yield operand
+
+    def axis(self, ax):
+        return self._ax_dict[ax]
+
+    @property
+    def axes(self):
+        return self._axes
+
+    @property
+    def ax_dict(self):
+        return dict(self._ax_dict)
+
+    def __repr__(self):
+        return "DatasetExpression({})".format(", ".join("{}[{}]".format(key, len(self._ax_dict[key])) for key in self._axes))
+
+
+class DatasetBuilder:
+    """
+    Builds a dataset from slices appended one by one along a new first axis,
+    like the spectra of a power sweep. This is much faster than repeatedly using
+    expand and join, as every slice is only copied once.
+
+    The other axes can be given as keyword arguments, or are taken from the first
+    appended slice if it's a dataset. If the number of slices is known, pass it as
+    count to allocate the memory in advance. Otherwise the buffer grows as needed.
+    The dtype is that of the first slice, unless given.
+    """
+    def __init__(self, axis, count=None, dtype=None, cut=None, **axes):
+        self._axis = axis
+        self._ax_dict = axes if axes else None
+        self._count = count
+        self._dtype = dtype
+        self._cut = cut
+        self._buffer = None
+        self._values = []
+
+    def append(self, data, value):
+        """
+        Add a slice (a dataset or an array) with the given value of the new axis.
+        """
+        if isinstance(data, dataset):
+            if self._ax_dict is None:
+                self._ax_dict = data.ax_dict
+            data = data.raw
+        data = np.asarray(data)
+        n = len(self._values)
+        if self._buffer is None:
+            dtype = data.dtype if self._dtype is None else self._dtype
+            self._buffer = np.empty((self._count or 16,) + data.shape, dtype)
+        elif data.shape != self._buffer.shape[1:]:
+            raise IndexError("The shape of the slice does not match the previous ones.")
+        elif n == len(self._buffer):
+            # Grow geometrically, so that appending takes amortised constant time
+            new_buffer = np.empty((2*n,) + self._buffer.shape[1:], self._buffer.dtype)
+            new_buffer[:n] = self._buffer
+            self._buffer = new_buffer
+        self._buffer[n] = data
+        self._values.append(value)
+
+    def build(self):
+        """
+        Return the dataset built so far. Its data is a view on the buffer, not a copy.
+        """
+        if self._buffer is None:
+            raise ValueError("No slices have been appended.")
+        if self._ax_dict is None:
+            raise ValueError("The axes of the slices are not known, pass them to DatasetBuilder.")
+        return dataset(self._buffer[:len(self._values)], cut=self._cut,
+                       **{self._axis: np.asarray(self._values)}, **self._ax_dict)
+
+    def __len__(self):
+        return len(self._values)
+
+
 class datalist:
     def __init__(self, axis, cut=None):
         self._axes = [axis,]
@@ -276,12 +1981,13 @@ class datalist:
     
     def add_cut(self, key, value):
         self._cut[key] = value
-        for ds in self:
+        # Not iterating over self, so that lazily loaded datasets aren't read
+        for ds in self._datasets:
             ds.add_cut(key, value)
     
-    def save(self, filename, compress=6):
-        with gzip.open(filename, 'wb', compresslevel=compress) as f:
-            pickle.dump(self, f)
+    def save(self, filename, compress=6, format='pickle', codec=None, chunk_size=_NATIVE_CHUNK_BYTES,
+             workers=None):
+        _save(self, filename, compress, format, codec, chunk_size, workers)
 
     @property
     def axis(self):
@@ -293,6 +1999,8 @@ class datalist:
     
     @property
     def datasets(self):
+        for i in range(len(self._datasets)):
+            self[i]
         return self._datasets
     
     @property
@@ -300,15 +2008,199 @@ class datalist:
         return self._cut
 
     def __getitem__(self, i):
-        return self._datasets[i]
+        if isinstance(i, slice):
+            return [self[j] for j in range(len(self._datasets))[i]]
+        item = self._datasets[i]
+        if isinstance(item, _lazy_dataset):
+            # Read a lazily loaded dataset on first access
+            item = self._datasets[i] = item.load()
+        return item
     
     def __len__(self):
         return len(self._datasets)
     
     def __repr__(self):
         return str(self._datasets)
+
+    def resample_to_common(self, axis, values=None, method='linear', fill=np.nan):
+        """
+        Resample all the datasets onto common values of 'axis' (those of the first
+        dataset by default), returning a new datalist. See dataset.resample.
+        """
+        if values is None:
+            values = self[0].axis(axis)
+        new_list = datalist(self._axes[0], cut=self._cut)
+        new_list.metadata = self.metadata
+        for ds, value in zip(self.datasets, self._axis):
+            new_list.append(ds.resample(method, fill, **{axis: values}), value)
+        return new_list
+
+    def index(self):
+        """Build a TreeIndex of the datasets in this datalist and any below it."""
+        return TreeIndex(self)
+
+    def pack(self, axis=None):
+        """
+        Pack the datasets into a PackedDatalist, concatenated along 'axis' (which can
+        have a different length in each dataset), so operations across all of them
+        can be done in single numpy calls. The other axes must have the same lengths.
+        By default 'axis' is the first axis of the first dataset.
+        """
+        return PackedDatalist(self, axis)
     
 
+class PackedDatalist:
+    """
+    A ragged, columnar form of a datalist, made with datalist.pack(axis). All the
+    datasets' raw data is concatenated along the ragged 'axis' into 'raw', with
+    item i taking rows offsets[i]:offsets[i+1]. The ragged axis values are stored
+    the same way in axes[axis], the other axes as (items, length) arrays. 'cuts' has
+    a column per cut key, with a matching boolean mask in 'has_cut' for datasets that
+    don't have that key.
+
+    unpack() gives back the original datalist.
+    """
+    def __init__(self, data, axis=None):
+        datasets = data.datasets
+        if axis is None:
+            axis = datasets[0].axes[0]
+        self.axis = axis
+        self.list_axis = data.axes[0]
+        self.list_values = list(data.axis)
+        self.cut = data.cut
+        self.metadata = data.metadata
+        self.item_axes = datasets[0].axes
+        self.item_metadata = [x.metadata for x in datasets]
+        if any(x.axes != self.item_axes for x in datasets):
+            raise ValueError("All datasets need the same axes to be packed")
+        dim = self.item_axes.index(axis)
+
+        lengths = [x.raw.shape[dim] for x in datasets]
+        self.offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+        self.raw = np.concatenate([np.moveaxis(np.asarray(x.raw), dim, 0) for x in datasets])
+        self.axes = {}
+        for key in self.item_axes:
+            values = [np.asarray(x.axis(key)) for x in datasets]
+            self.axes[key] = np.concatenate(values) if key == axis else np.stack(values)
+
+        keys = []
+        for x in datasets:
+            keys.extend(key for key in x.cut if key not in keys)
+        self.has_cut = {key: np.array([key in x.cut for x in datasets]) for key in keys}
+        self.cuts = {}
+        for key in keys:
+            column = [x.cut.get(key) for x in datasets]
+            try:
+                self.cuts[key] = np.array(column)
+            except ValueError:
+                self.cuts[key] = np.empty(len(column), object)
+                self.cuts[key][:] = column
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __repr__(self):
+        return "PackedDatalist({}[{}], {}[{}], {})".format(
+            self.list_axis, len(self), self.axis, len(self.raw),
+            ", ".join("{}[{}]".format(key, self.raw.shape[i+1]) for i, key in enumerate(self._rest)))
+
+    @property
+    def _rest(self):
+        return [key for key in self.item_axes if key != self.axis]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def items(self):
+        """The item index of each row of raw."""
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def take(self, i):
+        """
+        Row i along the ragged axis of every dataset, as an (items, ...) array.
+        Negative i counts from the end, so take(-1) gives the last row of each.
+        """
+        if np.any(self.lengths <= (i if i >= 0 else -i-1)):
+            raise IndexError("Index {} is out of range for some of the datasets".format(i))
+        return self.raw[self.offsets[:-1] + i if i >= 0 else self.offsets[1:] + i]
+
+    def reduce(self, op='sum'):
+        """
+        Reduce each dataset along the ragged axis, giving an (items, ...) array.
+        op can be 'sum', 'mean', 'max', 'min', 'std' or one of their nan versions.
+        Empty datasets give 0 for the sums and nan otherwise.
+        """
+        raw = self.raw
+        ufuncs = {'sum': np.add, 'max': np.maximum, 'min': np.minimum,
+                  'nansum': np.add, 'nanmax': np.fmax, 'nanmin': np.fmin}
+        nonempty = self.lengths > 0
+        starts = self.offsets[:-1][nonempty]
+
+        def segments(ufunc, arr):
+            out = np.full((len(self),) + raw.shape[1:], 0 if ufunc is np.add else np.nan,
+                          np.result_type(arr.dtype, np.float64) if ufunc is not np.add else arr.dtype)
+            if len(starts):
+                out[nonempty] = ufunc.reduceat(arr, starts, 0)
+            return out
+
+        lengths = self.lengths.reshape((-1,) + (1,)*(raw.ndim-1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if op in ('sum', 'max', 'min', 'nanmax', 'nanmin'):
+                return segments(ufuncs[op], raw)
+            if op == 'nansum':
+                return segments(np.add, np.where(np.isnan(raw), 0, raw))
+            if op == 'mean':
+                return segments(np.add, raw) / lengths
+            if op == 'nanmean':
+                return segments(np.add, np.where(np.isnan(raw), 0, raw)) / segments(np.add, (~np.isnan(raw)).astype(np.int64))
+            if op == 'std':
+                mean = segments(np.add, raw) / lengths
+                centred = raw - np.repeat(mean, self.lengths, 0)
+                return np.sqrt(segments(np.add, centred**2) / lengths)
+        raise ValueError("Unknown reduction: {}".format(op))
+
+    def map(self, func):
+        """
+        Apply func to the whole raw buffer at once, returning a new PackedDatalist.
+        func must return an array of the same shape, for example
+            packed.map(lambda raw: raw / raw.max(1, keepdims=True))
+        """
+        new_raw = np.asarray(func(self.raw))
+        if new_raw.shape != self.raw.shape:
+            raise ValueError("map needs func to keep the shape of the data")
+        new_data = copy.copy(self)
+        new_data.raw = new_raw
+        return new_data
+
+    def to_dense(self, fill=np.nan):
+        """
+        An (items, longest, ...) array with the datasets padded with 'fill'.
+        """
+        dtype = np.result_type(self.raw.dtype, np.min_scalar_type(fill))
+        out = np.full((len(self), np.max(self.lengths, initial=0)) + self.raw.shape[1:], fill, dtype)
+        items = self.items
+        out[items, np.arange(len(self.raw)) - self.offsets[items]] = self.raw
+        return out
+
+    def unpack(self):
+        """Get the datalist back."""
+        new_list = datalist(self.list_axis, cut=self.cut)
+        new_list.metadata = self.metadata
+        dim = self.item_axes.index(self.axis)
+        for i in range(len(self)):
+            a, b = self.offsets[i], self.offsets[i+1]
+            axes = {key: self.axes[key][a:b] if key == self.axis else self.axes[key][i]
+                    for key in self.item_axes}
+            cut = {key: self.cuts[key][i].item() if isinstance(self.cuts[key][i], np.generic) else self.cuts[key][i]
+                   for key in self.cuts if self.has_cut[key][i]}
+            new_data = dataset(np.moveaxis(self.raw[a:b], 0, dim), cut=cut, **axes)
+            new_data.metadata = self.item_metadata[i]
+            new_list.append(new_data, self.list_values[i])
+        return new_list
+
+
 class datadict:
     def __init__(self, name, cut=None):
         self._name = name
@@ -326,9 +2218,9 @@ class datadict:
             except AttributeError:
                 pass
     
-    def save(self, filename, compress=6):
-        with gzip.open(filename, 'wb', compresslevel=compress) as f:
-            pickle.dump(self, f)
+    def save(self, filename, compress=6, format='pickle', codec=None, chunk_size=_NATIVE_CHUNK_BYTES,
+             workers=None):
+        _save(self, filename, compress, format, codec, chunk_size, workers)
     
     @property
     def name(self):
@@ -336,6 +2228,8 @@ class datadict:
     
     @property
     def dict(self):
+        for key in self._dict:
+            self[key]
         return self._dict
     
     @property
@@ -355,13 +2249,344 @@ class datadict:
             yield key
     
     def __getitem__(self, key):
-        return self._dict[key]
+        item = self._dict[key]
+        if isinstance(item, _lazy_dataset):
+            # Read a lazily loaded dataset on first access
+            item = self._dict[key] = item.load()
+        return item
     
     def __contains__(self, item):
         return item in self._dict
     
     def keys(self):
         return self._dict.keys()
+
+    def index(self):
+        """Build a TreeIndex of the datasets in this datadict and any below it."""
+        return TreeIndex(self)
     
     def __repr__(self):
-        return "datadict({}: {})".format(self._name, ", ".join(self._dict.keys()))
\ No newline at end of file
+        return "datadict({}: {})".format(self._name, ", ".join(self._dict.keys()))
+
+
+def _cut_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class TreeIndex:
+    """
+    An index of the datasets in a tree of datalists and datadicts, built once so
+    that finding a dataset is a dict lookup rather than a walk through the tree:
+
+        tree = data.index()
+        tree.find(x=3, y=5)
+        tree.select(lambda cut: cut['power'] > 10)
+        tree[2, 'a', 0]
+
+    Datasets are found by their cut, or by their path - the datalist positions and
+    datadict keys leading to them. Lazily loaded datasets are only read when returned.
+    The index doesn't follow later changes to the tree, so rebuild it if needed.
+    """
+    def __init__(self, tree):
+        self._leaves = []
+        self._paths = {}
+        self._by_cut = {}
+        self._add(tree, ())
+
+    def _add(self, node, path):
+        if isinstance(node, datalist):
+            children = enumerate(node._datasets)
+        elif isinstance(node, datadict):
+            children = node._dict.items()
+        else:
+            return
+        for key, child in children:
+            if isinstance(child, (dataset, _lazy_dataset)):
+                self._add_leaf(node, key, child, path + (key,))
+            else:
+                self._add(child, path + (key,))
+
+    def _add_leaf(self, parent, key, leaf, path):
+        i = len(self._leaves)
+        self._leaves.append((parent, key, path))
+        self._paths[path] = i
+        for item in leaf.cut.items():
+            item = item[0], _cut_value(item[1])
+            try:
+                self._by_cut.setdefault(item, []).append(i)
+            except TypeError:
+                # Unhashable values can still be found with select
+                pass
+
+    def _get(self, i):
+        parent, key, path = self._leaves[i]
+        return parent[key]
+
+    def __len__(self):
+        return len(self._leaves)
+
+    def __getitem__(self, path):
+        if not isinstance(path, tuple):
+            path = (path,)
+        return self._get(self._paths[path])
+
+    def get(self, path, fresh=False):
+        """
+        The dataset at path, like tree[path]. With fresh=True, it's read again (if loaded
+        lazily) or copied, and not kept in the tree, so changes to it don't carry over.
+        """
+        if not isinstance(path, tuple):
+            path = (path,)
+        parent, key, path = self._leaves[self._paths[path]]
+        if not fresh:
+            return parent[key]
+        leaf = parent._datasets[key] if isinstance(parent, datalist) else parent._dict[key]
+        if isinstance(leaf, _lazy_dataset):
+            new_data = leaf.load()
+            new_data._cut = dict(leaf.cut)
+            return new_data
+        return copy.deepcopy(leaf)
+
+    @property
+    def paths(self):
+        return [leaf[2] for leaf in self._leaves]
+
+    def find_all(self, **cut):
+        """All the datasets with the given cut values, in tree order."""
+        if not cut:
+            return [self._get(i) for i in range(len(self))]
+        matches = sorted((self._by_cut.get((key, _cut_value(value)), []) for key, value in cut.items()), key=len)
+        found = set(matches[0]).intersection(*matches[1:])
+        return [self._get(i) for i in sorted(found)]
+
+    def find(self, **cut):
+        """
+        The dataset with the given cut values, for example find(x=3, y=5).
+        Raises a KeyError if there's no such dataset, or a ValueError if there are several.
+        """
+        found = self.find_all(**cut)
+        if not found:
+            raise KeyError(cut)
+        if len(found) > 1:
+            raise ValueError("{} datasets match {}".format(len(found), cut))
+        return found[0]
+
+    def select(self, condition):
+        """All the datasets whose cut passes condition(cut), in tree order."""
+        selected = []
+        for parent, key, path in self._leaves:
+            leaf = parent._datasets[key] if isinstance(parent, datalist) else parent._dict[key]
+            # Lazily loaded datasets know their cut, so they're only read if selected
+            if condition(leaf.cut):
+                selected.append(parent[key])
+        return selected
+
+    def datasets(self, keep=True):
+        """
+        Yield the datasets one by one, in tree order. With keep=False, lazily loaded
+        datasets are read without being kept in the tree, so going through a big file
+        loaded with lazy=True only holds one of them in memory at a time.
+        """
+        for parent, key, path in self._leaves:
+            leaf = parent._datasets[key] if isinstance(parent, datalist) else parent._dict[key]
+            if isinstance(leaf, _lazy_dataset) and not keep:
+                yield leaf.load()
+            else:
+                yield parent[key]
+
+
+# Instrumentation, see instrument. Nothing here runs unless it's switched on,
+# as the instrumented functions are only swapped in while it's active.
+
+_recorder = None
+_instrument_lock = threading.Lock()
+_instrument_active = None
+
+
+def _count(**counts):
+    # Called from the I/O code to attribute bytes to the call being recorded
+    recorder = _recorder
+    if recorder is not None:
+        recorder.count(counts)
+
+
+class Instrumentation:
+    """
+    The calls recorded by instrument. 'stats' holds the totals for each function:
+    call count, wall time and bytes read, decompressed and allocated. The counts are
+    inclusive, so a load includes the dataset.__init__ calls it makes. Allocated bytes
+    are the growth in memory traced by tracemalloc during the call (numpy reports to it).
+    """
+    _counters = ('bytes_read', 'bytes_decompressed', 'bytes_allocated')
+
+    def __init__(self, memory=True, max_events=1000000):
+        self.memory = memory
+        self.max_events = max_events
+        self.stats = {}
+        self.events = []
+        self.dropped = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def count(self, counts):
+        stack = getattr(self._local, 'stack', None)
+        if stack:
+            frame = stack[-1]
+            for key, n in counts.items():
+                frame[key] += n
+
+    def call(self, name, func, args, kwargs):
+        stack = self._local.__dict__.setdefault('stack', [])
+        frame = dict.fromkeys(self._counters, 0)
+        stack.append(frame)
+        memory = self.memory and tracemalloc.is_tracing()
+        before = tracemalloc.get_traced_memory()[0] if memory else 0
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            if memory:
+                frame['bytes_allocated'] = max(tracemalloc.get_traced_memory()[0] - before, 0)
+            stack.pop()
+            if stack:
+                stack[-1]['bytes_read'] += frame['bytes_read']
+                stack[-1]['bytes_decompressed'] += frame['bytes_decompressed']
+            with self._lock:
+                stats = self.stats.get(name)
+                if stats is None:
+                    stats = self.stats[name] = dict(calls=0, time=0., **dict.fromkeys(self._counters, 0))
+                stats['calls'] += 1
+                stats['time'] += duration
+                for key in self._counters:
+                    stats[key] += frame[key]
+                if len(self.events) < self.max_events:
+                    self.events.append((name, start, duration, threading.get_ident(), frame))
+                else:
+                    self.dropped += 1
+
+    def summary(self):
+        """The stats as a table, slowest functions first."""
+        lines = ["{:<18} {:>8} {:>10} {:>10} {:>11} {:>12} {:>11}".format(
+            'function', 'calls', 'total s', 'mean us', 'read MB', 'decompr. MB', 'alloc. MB')]
+        for name, stats in sorted(self.stats.items(), key=lambda x: -x[1]['time']):
+            lines.append("{:<18} {:>8} {:>10.4f} {:>10.1f} {:>11.2f} {:>12.2f} {:>11.2f}".format(
+                name, stats['calls'], stats['time'], stats['time'] / stats['calls'] * 1e6,
+                stats['bytes_read'] / 1e6, stats['bytes_decompressed'] / 1e6, stats['bytes_allocated'] / 1e6))
+        if self.dropped:
+            lines.append("({} calls not kept in the trace)".format(self.dropped))
+        return "\n".join(lines)
+
+    def print_summary(self, file=None):
+        print(self.summary(), file=file)
+
+    def chrome_trace(self):
+        """The recorded calls in the Chrome trace format, for chrome://tracing or Perfetto."""
+        pid = os.getpid()
+        return {'traceEvents': [
+            {'name': name, 'cat': 'datasets', 'ph': 'X', 'pid': pid, 'tid': tid,
+             'ts': (start - self._start) * 1e6, 'dur': duration * 1e6, 'args': counts}
+            for name, start, duration, tid, counts in self.events
+        ]}
+
+    def save_trace(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+def _instrument_targets():
+    module = sys.modules[__name__]
+    return [
+        (module, 'load', 'load'),
+        (module, '_save', 'save'),
+        (dataset, '__init__', 'dataset.__init__'),
+        (dataset, 'take', 'dataset.take'),
+        (dataset, 'take_raw', 'dataset.take_raw'),
+        (dataset, 'take_sum', 'dataset.take_sum'),
+        (dataset, 'join', 'dataset.join'),
+    ]
+
+
+def _instrumented(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        recorder = _recorder
+        if recorder is None:
+            return func(*args, **kwargs)
+        return recorder.call(name, func, args, kwargs)
+    return wrapper
+
+
+def _start_instrumenting(recorder):
+    global _recorder, _instrument_active
+    with _instrument_lock:
+        previous = _recorder
+        if _instrument_active is None:
+            originals = []
+            for owner, attr, name in _instrument_targets():
+                func = vars(owner)[attr]
+                originals.append((owner, attr, func))
+                setattr(owner, attr, _instrumented(name, func))
+            started = recorder.memory and not tracemalloc.is_tracing()
+            if started:
+                tracemalloc.start()
+            _instrument_active = originals, started
+        _recorder = recorder
+    return previous
+
+
+def _stop_instrumenting(previous):
+    global _recorder, _instrument_active
+    with _instrument_lock:
+        _recorder = previous
+        if previous is None and _instrument_active is not None:
+            originals, started = _instrument_active
+            for owner, attr, func in originals:
+                setattr(owner, attr, func)
+            if started:
+                tracemalloc.stop()
+            _instrument_active = None
+
+
+@contextlib.contextmanager
+def instrument(memory=True):
+    """
+    Record what load, save, dataset.__init__, take, take_raw, take_sum and join
+    do inside the with block:
+
+        with ds.instrument() as record:
+            data = ds.load(filename)
+            ...
+        record.print_summary()
+        record.save_trace('trace.json')
+
+    memory=False skips tracing memory allocations, which slows things down a bit.
+    Outside instrument blocks the functions are the plain, unwrapped ones, so there's
+    no overhead. Setting the DSUITE_INSTRUMENT environment variable instruments the
+    whole program, printing the summary on exit - and saving the trace too if the
+    variable is set to a .json filename.
+    """
+    recorder = Instrumentation(memory)
+    previous = _start_instrumenting(recorder)
+    try:
+        yield recorder
+    finally:
+        _stop_instrumenting(previous)
+
+
+def _instrument_from_environment(value):
+    recorder = Instrumentation()
+    _start_instrumenting(recorder)
+
+    def report():
+        recorder.print_summary(sys.stderr)
+        if value.endswith('.json'):
+            recorder.save_trace(value)
+    atexit.register(report)
+
+
+if os.environ.get('DSUITE_INSTRUMENT'):
+    _instrument_from_environment(os.environ['DSUITE_INSTRUMENT'])
@@ -49,33 +49,27 @@ def make_pdf(data, name=None):
 
 prefix = "prefix"
 base = "folder"
-files = ds.glob(os.path.join(base, prefix+"_X_*"), no=('raw',))
+index = ds.FileIndex(base, ['_P_', '_I_', '_X_', '_Y_']).filter(prefix+"_X_*", no=('raw',))
 
 ds_wrapper = ds.datalist("wrap")
 ds_main = ds.datalist("x")
-for x in set([ds.extract(x, '_X_')[0] for x in files]):
+for x in index.unique('X'):
     ds_x = ds.datalist("y")
-    for y in set([ds.extract(x, '_Y_')[0] for x in files]):
-        fnames = ds.glob(os.path.join(base, prefix+"_X_{}_Y_{}*".format(x, y)), no=('raw',))
-        ds.sort_by(fnames, "_P_")
-        ds_scan = None
-        for fname in fnames:
+    for y in index.unique('Y'):
+        scan = index.where(X=x, Y=y).sort_by('P')
+        builder = ds.DatasetBuilder('power', count=len(scan))
+        # The laser power and integration time come straight from the index
+        for fname, P, I in zip(scan, scan['P'].astype(int), scan['I'].astype(int)):
             # print(x, y, P)
-            # Get the laser power and integration time using their regex signatures
-            P, I = ds.extract(fname, "_P_", "_I_")
             # Get the data out of the file
             # wls, counts = np.genfromtxt(file, delimiter=",", unpack=True, skip_header=1)
             spe_files = sl.load_from_files([fname])
             wls = spe_files.wavelength
             counts = np.squeeze(spe_files.data)
             counts /= I/100
-            # Make a dataset and join it with the full power scan one. Need to add a 'power' axis for that, dim 1
-            ds_single = ds.dataset(counts, wl=wls).expand('power', P/1000)
-            if ds_scan:
-                ds_scan = ds_scan.join(ds_single, "power")
-            else:
-                ds_scan = ds_single
-        ds_x.append(ds_scan, y)
+            # Add the spectrum to the full power scan, along a new 'power' axis
+            builder.append(ds.dataset(counts, wl=wls), P/1000)
+        ds_x.append(builder.build(), y)
     ds_main.append(ds_x, x)
 ds_wrapper.append(ds_main, 'yes')
 
@@ -15,7 +15,7 @@ class DataViewer(QtWidgets.QWidget):
     def __init__(self, filename, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.dataset = ds.load(filename)
+        self.dataset = ds.load(filename, lazy=True)
 
         self.layout = QtWidgets.QGridLayout()
         if isinstance(self.dataset, ds.datalist):
@@ -30,9 +30,10 @@ class HSViewer(QtWidgets.QWidget):
             self._plots.append(plot)
             self._images.append(image)
 
-        self.dataset = ds.load(self.filename)
-        self.dataset._raw -= self.dataset.metadata['background']
-        self._images[0].setImage(np.amax(self.dataset.raw, 2))
+        data = ds.load(self.filename, mmap=True)
+        # Subtracted lazily, so only the parts shown are read from the file
+        self.dataset = (data - data.metadata['background']).lazy()
+        self._images[0].setImage(self.dataset.reduce('wl', 'max').raw)
 
         line_pos = pg.InfiniteLine(0, 0, movable=True)
         line_pos.sigPositionChanged.connect(self._updated_pos)
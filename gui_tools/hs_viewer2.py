@@ -90,14 +90,15 @@ class HSView(file_viewer.FileView):
         return layout
     
     def set_file(self, filename):
-        self._data = ds.load(filename)
-        self._data._raw -= self._data.metadata['background']
+        data = ds.load(filename, mmap=True)
+        # Subtracted lazily, so only the parts shown are read from the file
+        self._data = (data - data.metadata['background']).lazy()
         self._images[0].setImage(self._data.take_sum('wl').raw)
         self._netname = ds.extract_raw(filename, '(Net[A-Z0-9]*)')[0]
         self._transform_lines()
         self._target_moved(self._controls['target'])
         self._wl_line_moved(self._controls['wl_line'])
-        self._lines[1].setData(np.amax(np.amax(self._data.raw, 0), 0))
+        self._lines[1].setData(self._data.reduce(['pos', 'y'], 'max').raw)
 
     def _target_moved(self, target):
         x, y = target.pos()
@@ -105,8 +106,10 @@ class HSView(file_viewer.FileView):
         self._controls['target_2'].setPos(x + .5, y + .5)
         self._controls['space_line'].setValue(x + .5)
         self._controls['space_line_2'].setValue(y + .5)
-        self._images[1].setImage(self._data.take(pos=x).raw)
-        counts = self._data.take(pos=x).take(y=y).raw
+        # A view is enough here, and much faster than taking a full dataset
+        view = self._data.view(pos=x)
+        self._images[1].setImage(view.raw)
+        counts = view.take(y=y).raw
         self._lines[0].setData(counts)
         peaks, _ = signal.find_peaks(counts, prominence=50)
         self._lines[2].setData(peaks, counts[peaks])
@@ -11,6 +11,39 @@ from tqdm import tqdm
 
 import sys, os
 
+def load_meta(file, fields=None):
+    if 'ds' in file:
+        return ds.load(file, fields=fields)
+    from scipy.io import loadmat
+    data = loadmat(file, variable_names=fields)
+    for key in data.keys():
+        data[key] = np.squeeze(data[key])
+    return data
+
+
+def load_all_meta(files, progress=iter, fields=None):
+    """
+    Load the metadata of many files, returning the files that loaded, their metadata
+    (in the same order), and a LoadError for each file that didn't.
+    """
+    # Files load in parallel and finish in any order, so put them back in order here
+    results = ds.load_many(files, stream=True, loader=load_meta, fields=fields)
+    loaded = dict(progress(tqdm(results, total=len(files))))
+    good = [file for file in files if not isinstance(loaded[file], ds.LoadError)]
+    failed = [loaded[file] for file in files if isinstance(loaded[file], ds.LoadError)]
+    return good, [loaded[file] for file in good], failed
+
+
+def report_failed(parent, failed):
+    # Let the user know which files were left out
+    if failed:
+        dlg = QtWidgets.QMessageBox(parent)
+        dlg.setWindowTitle("Error")
+        dlg.setText("{} file(s) could not be loaded and were skipped".format(len(failed)))
+        dlg.setDetailedText("\n".join(str(e) for e in failed))
+        dlg.exec()
+
+
 class MetaView(file_viewer.FileView):
     def custom_layout(self):
         """
@@ -55,8 +88,10 @@ class MetaView(file_viewer.FileView):
             'time_taken': []
         }
 
-        for file in tqdm(files):
-            data = ds.load(file)
+        # Only the scalars are needed, which is quick for files saved with format='members'
+        files, metadata, failed = load_all_meta(files, fields=list(tracked_vals))
+        report_failed(self, failed)
+        for data in metadata:
             for key in tracked_vals.keys():
                 tracked_vals[key].append(data[key])
         
@@ -158,14 +193,10 @@ class MetaView2(file_viewer.FileView):
         fpf = []
         stage_pos = []
 
-        for i, file in enumerate(self.params['loading'].iter(tqdm(files))):
-            if 'ds' in file:
-                data = ds.load(file)
-            else:
-                from scipy.io import loadmat
-                data = loadmat(file)
-                for key in data.keys():
-                    data[key] = np.squeeze(data[key])
+        # The slider goes through the files that loaded, so self.files[i] goes with it
+        self.files, metadata, failed = load_all_meta(files, self.params['loading'].iter)
+        report_failed(self, failed)
+        for data in metadata:
             spectra.append(data['reference_spectra'])
             full.append(data['full_power_spectrum'])
             bg.append(data['background'])
@@ -205,7 +236,7 @@ class MetaView2(file_viewer.FileView):
             np.amax([np.amax(powers), np.amax(ref_powers)])
         )
 
-        self.slider.setMaximum(len(files)-1)
+        self.slider.setMaximum(len(metadata)-1)
         self._update_i(0)
 
     def _update_i(self, i):
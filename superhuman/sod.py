@@ -36,7 +36,7 @@ def show(prefix = None):
     ds.sort_by(files, "_P_")
 
     # Read the files into a dataset (in contrast to a datalist, we know the dimensions will be ok here)
-    ds_scan = None
+    builder = ds.DatasetBuilder('power', count=len(files))
     progress_bar.setMaximum(len(files))
     for i, file in enumerate(files): # Power files in a run
         # print(file)
@@ -49,13 +49,10 @@ def show(prefix = None):
         counts = np.squeeze(spe_files.data)
         # Normalise integration time to 100ms
         counts /= I/100
-        # Make a dataset and join it with the full power scan one. Need to add a 'power' axis for that, dim 1
-        ds_single = ds.dataset(counts, wl=wls).expand('power', P/1000)
-        if ds_scan:
-            ds_scan = ds_scan.join(ds_single, "power")
-        else:
-            ds_scan = ds_single
+        # Add the spectrum to the full power scan, along a new 'power' axis
+        builder.append(ds.dataset(counts, wl=wls), P/1000)
         progress_bar.setValue(i+1)
+    ds_scan = builder.build()
     print(ds_scan)
     spw = super_peakfinder.SuperPeakfinder(number.value(), ds_scan, {}, prefix)
     spw.show()
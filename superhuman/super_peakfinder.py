@@ -2,6 +2,7 @@ import superhuman
 import datasets1 as ds
 
 import numpy as np
+import re
 from scipy import signal
 import sqlite3
 from io import BytesIO
@@ -323,19 +324,19 @@ class SuperPeakfinder(superhuman.SuperWidget):
         return indices, fit_c, fit
 
     def wl_to_i(self, wl):
-        m = np.amax(self.dataset.wl)
-        try:
-            return np.array([np.argwhere(self.dataset.wl>=x)[0,0] if x<m else len(self.dataset.wl) for x in wl])
-        except TypeError:
-            return np.argwhere(self.dataset.wl>=wl)[0,0] if wl<m else len(self.dataset.wl)
+        return self.value_to_i('wl', wl)
 
     def power_to_i(self, power):
         #TODO rethink the default of returning len()
-        m = np.amax(self.dataset.power)
-        try:
-            return np.array([np.argwhere(self.dataset.power>=x)[0,0] if x<m else len(self.dataset.power) for x in power])
-        except TypeError:
-            return np.argwhere(self.dataset.power>=power)[0,0] if power<m else len(self.dataset.power)
+        return self.value_to_i('power', power)
+
+    def value_to_i(self, axis, x):
+        # The first index with a value >= x, or the length of the axis if x is not below its maximum
+        values = self.dataset.axis(axis)
+        m = np.amax(values)
+        i = self.dataset.find_index(axis, np.minimum(x, m), 'backfill')
+        i = np.where(np.asarray(x) < m, i, len(values))
+        return int(i) if i.ndim == 0 else i
 
 class SuperPeakCycler(superhuman.SuperCycler):
     def __init__(self, superwidget, datafile_name, dbconn, param_spec, name, *args, **kwargs):
@@ -356,6 +357,7 @@ class SuperPeakCycler(superhuman.SuperCycler):
         for i, b in enumerate(data):
             b.add_cut('indices', ",".join((str(i),)))
             datalist.append(b)
+        self.tree = data.index()
         super().__init__(superwidget, datalist, dbconn, param_spec, name, *args, **kwargs)
 
     def make_advance(self):
@@ -388,11 +390,16 @@ class SuperPeakCycler(superhuman.SuperCycler):
         return [peak_id], dataset, params
 
     def get_from_row(self, row):
-        indices = ds.extract_raw(row['cut'], "'indices': '([0-9,]+)'")[0]
-        data = self.initial_data
-        for index in [int(x) for x in indices.split(',')]:
-            data = data[index]
-        return [row['peak_id']], data
+        # The cut is stored as text (see make_advance), with the indices added in __init__,
+        # which the dataset is then looked up by in the index
+        match = re.search("'indices': '([0-9,]+)'", row['cut'])
+        if match is None:
+            raise KeyError("No indices in the saved cut {}".format(row['cut']))
+        try:
+            dataset = self.tree.find(indices=match.group(1))
+        except KeyError:
+            raise KeyError("No dataset in {} has indices {}".format(self.datafile_name, match.group(1))) from None
+        return [row['peak_id']], dataset
 
     def skip_all(self):
         print('called')
@@ -2,6 +2,7 @@ import superhuman
 import datasets1 as ds
 
 import numpy as np
+import functools
 from scipy import signal
 import sqlite3
 from io import BytesIO
@@ -125,16 +126,21 @@ class SuperPeakfinder(superhuman.SuperWidget):
             return np.argwhere(self.powers>=power)[0,0] if power<m else len(self.powers)
 
 
+@functools.lru_cache(maxsize=4)
+def _tree(datafile):
+    # The indexes of the last few data files, so going through rows of one file only loads it once
+    return ds.load(datafile, lazy=True).index()
+
+
 class SuperPeakCycler(superhuman.SuperCycler):
     def __init__(self, superwidget, dbconn, param_spec, name, *args, **kwargs):
         datalist = []
         super().__init__(superwidget, datalist, dbconn, param_spec, name, *args, **kwargs)
 
     def get_from_row(self, row):
-        data = ds.load(row['datafile'])
-        for index in [int(x) for x in row['indices'].split(', ')]:
-            data = data[index]
-        return [], data
+        path = tuple(int(x) for x in row['indices'].split(', '))
+        # A fresh dataset every time, so changes made while viewing it aren't kept
+        return [], _tree(row['datafile']).get(path, fresh=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,13 @@
+import os
+import sys
+
+# The packages live at the top of the repository, which isn't installed, and
+# superhuman's modules import each other from its folder
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [root, os.path.join(root, 'superhuman')]
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import datasets
+
+# The processors import datasets under the name it's installed with in the lab
+sys.modules.setdefault('datasets1', datasets)
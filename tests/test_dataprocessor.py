@@ -0,0 +1,283 @@
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import datasets as ds
+from dataprocessor import DataProcessor, ForEachProcessor, dag, UndeclaredKeyError, Prefetch
+
+
+class Tracker:
+    # Like PL_Subtractor2, an object in storage that a processor changes in place
+    def __init__(self):
+        self.value = None
+
+    def update(self, value):
+        self.value = value
+
+
+class TrackPeaksProcessor(DataProcessor):
+    inputs = ('tracker',)
+    outputs = ('peak',)
+    mutates = ('tracker',)
+
+    def run(self, dataset):
+        for peak in range(3):
+            self.storage['peak'] = peak
+            self.storage['tracker'].update(dataset * 10 + peak)
+            # Give the other branches a chance to change the tracker, if it were shared
+            time.sleep(0.001)
+            self.run_next(dataset)
+
+
+def _insert(storage, dataset, peak, value):
+    storage['dbconn'].execute("INSERT INTO rows VALUES (?, ?, ?)", (dataset, peak, value))
+    storage['threads'].add(threading.get_ident())
+
+
+class SaveRowProcessor(DataProcessor):
+    inputs = ('peak', 'tracker')
+
+    def run(self, dataset):
+        time.sleep(0.001)
+        self.run_in_parent(_insert, dataset, self.storage['peak'], self.storage['tracker'].value)
+        self.run_next(dataset)
+
+
+def run_rows(executor):
+    dbconn = sqlite3.connect(":memory:")
+    dbconn.execute("CREATE TABLE rows (dataset, peak, value)")
+    storage = {'tracker': Tracker(), 'dbconn': dbconn, 'threads': set()}
+    pipeline = DataProcessor([ForEachProcessor, TrackPeaksProcessor, SaveRowProcessor], storage)
+    pipeline.set_executor(executor, workers=4)
+    pipeline.run(list(range(8)))
+    return dbconn.execute("SELECT * FROM rows").fetchall(), storage
+
+
+def test_thread_branches_match_serial():
+    serial, _ = run_rows(None)
+    threaded, storage = run_rows('thread')
+    assert threaded == serial
+    assert serial == [(d, p, d*10 + p) for d in range(8) for p in range(3)]
+    # The database was only used from the thread that made the connection
+    assert storage['threads'] == {threading.get_ident()}
+    # Every branch changed its own copy of the tracker
+    assert storage['tracker'].value is None
+
+
+class SquareProcessor(DataProcessor):
+    outputs = ('square',)
+
+    def run(self, dataset):
+        self.storage['square'] = dataset**2
+        self.run_next(dataset)
+
+
+def test_profiling_thread_branches():
+    storage = {}
+    pipeline = ForEachProcessor([SquareProcessor], storage)
+    pipeline.set_executor('thread', workers=4)
+    profile = pipeline.set_profiling()
+    assert 'run' not in vars(pipeline)
+    pipeline.run(list(range(5)))
+    calls = {name: stats['calls'] for (position, name), stats in profile.stats.items()}
+    assert calls == {'ForEachProcessor': 1, 'SquareProcessor': 5}
+    assert storage['square'] == 16
+
+
+class DoubleProcessor(DataProcessor):
+    outputs = ('double',)
+
+    def run(self, dataset):
+        self.storage['double'] = dataset.raw * 2
+        self.run_next(dataset)
+
+    def run_batch(self, batch, storages):
+        return [{'double': raw} for raw in batch.raw * 2]
+
+
+def test_profiling_batches():
+    storage = {}
+    pipeline = ForEachProcessor([DoubleProcessor], storage)
+    profile = pipeline.set_profiling()
+    pipeline.run([ds.dataset(np.arange(3) + i, x=np.arange(3)) for i in range(12)])
+    rows = {row['processor']: row for row in profile.to_dict()}
+    # One call for the whole batch, but the rate is per item
+    assert rows['DoubleProcessor']['calls'] == 1 and rows['DoubleProcessor']['items'] == 12
+    assert rows['DoubleProcessor']['items_per_second'] == 12 / rows['DoubleProcessor']['inclusive']
+    assert list(storage['double']) == [22, 24, 26]
+
+
+class ConfiguredProcessor(DataProcessor):
+    # Reads an undeclared key when made, like ConvertPowerProcessor did with power_file
+    outputs = ('scaled',)
+
+    def __init__(self, pipeline=None, storage=None):
+        self.scale = storage['scale']
+        super().__init__(pipeline, storage)
+
+    def run(self, dataset):
+        self.storage['scaled'] = dataset * self.scale
+        self.run_next(dataset)
+
+
+class UndeclaredProcessor(DataProcessor):
+    outputs = ('offset',)
+
+    def run(self, dataset):
+        self.storage['offset'] = dataset + self.storage['scale']
+        self.run_next(dataset)
+
+
+def test_dag_only_checks_keys_while_running():
+    storage = {'scale': 3}
+    pipeline = DataProcessor([dag(ConfiguredProcessor, SquareProcessor)], storage)
+    pipeline.run(2)
+    assert storage['scaled'] == 6 and storage['square'] == 4
+
+    pipeline = DataProcessor([dag(UndeclaredProcessor, SquareProcessor)], {'scale': 3})
+    with pytest.raises(UndeclaredKeyError):
+        pipeline.run(2)
+
+
+def test_dag_rejects_fanning_out_stages():
+    with pytest.raises(ValueError):
+        dag(SquareProcessor, ForEachProcessor)
+
+
+class CollectProcessor(DataProcessor):
+    def run(self, dataset):
+        self.storage.setdefault('rows', []).append((dataset, self.storage['square']))
+        self.run_next(dataset)
+
+
+def test_dag_with_outputs_in_storage(tmp_path):
+    # Left over from an earlier run, so recomputed for every item
+    storage = {'square': -1}
+    pipeline = DataProcessor([ForEachProcessor, dag(SquareProcessor), CollectProcessor], storage)
+    pipeline.run([0, 1, 2])
+    assert storage['rows'] == [(0, 0), (1, 1), (2, 4)]
+
+    # Given on purpose, so used for every item
+    storage = {'square': -1}
+    pipeline = DataProcessor([ForEachProcessor, dag(SquareProcessor, skip_present=True), CollectProcessor],
+                             storage)
+    pipeline.run([0, 1, 2])
+    assert storage['rows'] == [(0, -1), (1, -1), (2, -1)]
+
+    # Only what was given when the pipeline was made counts, not what it wrote itself
+    storage = {}
+    pipeline = DataProcessor([ForEachProcessor, dag(SquareProcessor, skip_present=True), CollectProcessor],
+                             storage)
+    pipeline.run([0, 1, 2])
+    pipeline.run([3, 4])
+    assert storage['rows'] == [(0, 0), (1, 1), (2, 4), (3, 9), (4, 16)]
+
+    # Nor what a journal restored for the units it skipped
+    for items in ([0, 1, 2], [0, 1, 2, 3, 4]):
+        storage = {}
+        pipeline = DataProcessor([ForEachProcessor, dag(SquareProcessor, skip_present=True), CollectProcessor],
+                                 storage)
+        journal = pipeline.set_journal(str(tmp_path / 'squares.journal'))
+        pipeline.run(items, resume=True)
+        journal.close()
+    assert storage['rows'] == [(3, 9), (4, 16)]
+
+
+class CrashProcessor(DataProcessor):
+    # Stands in for a crash partway through a run
+    def run(self, dataset):
+        self.storage['seen'].append(dataset)
+        if dataset == self.storage['crash_at']:
+            raise RuntimeError("Crashed on {}".format(dataset))
+        self.run_next(dataset)
+
+
+def test_resume_after_crash(tmp_path):
+    storage = {'scale': 3, 'seen': [], 'crash_at': 5}
+    pipeline = DataProcessor([ForEachProcessor, dag(ConfiguredProcessor, SquareProcessor), CrashProcessor],
+                             storage)
+    journal = pipeline.set_journal(str(tmp_path / 'run.journal'))
+    with pytest.raises(RuntimeError):
+        pipeline.run(list(range(8)))
+    assert len(journal) == 5
+
+    # The same pipeline carries on, even though its DAG has run since the units were recorded
+    storage['seen'] = []
+    storage['crash_at'] = None
+    pipeline.run(list(range(8)), resume=True)
+    assert storage['seen'] == [5, 6, 7]
+    assert journal.skipped == 5 and len(journal) == 8
+    assert storage['scaled'] == 21 and storage['square'] == 49
+    journal.close()
+
+
+def test_resume_with_any_processor_first(tmp_path):
+    storage = {}
+    pipeline = ForEachProcessor([SquareProcessor, CollectProcessor], storage)
+    journal = pipeline.set_journal(str(tmp_path / 'each.journal'))
+    pipeline.run([1, 2], resume=True)
+    pipeline.run([1, 2, 3], resume=True)
+    assert storage['rows'] == [(1, 1), (2, 4), (3, 9)]
+    assert journal.skipped == 2
+    journal.close()
+
+    storage = {'scale': 2}
+    dag(ConfiguredProcessor, SquareProcessor)([], storage).run(3, resume=False)
+    assert storage['scaled'] == 6 and storage['square'] == 9
+
+
+class SumProcessor(DataProcessor):
+    outputs = ('total',)
+
+    def run(self, dataset):
+        self.storage['total'] = int(np.sum(dataset.raw))
+        self.run_next(dataset)
+
+
+def test_journal_units_without_cuts(tmp_path):
+    # Datasets with no cut are told apart by their data
+    data = [ds.dataset(np.arange(3) + i, x=np.arange(3)) for i in range(4)]
+    storage = {}
+    pipeline = ForEachProcessor([SumProcessor], storage)
+    journal = pipeline.set_journal(str(tmp_path / 'plain.journal'))
+    pipeline.run(data, resume=True)
+    assert len(journal) == 4
+    pipeline.run(data + [ds.dataset(np.arange(3) + 9, x=np.arange(3))], resume=True)
+    assert journal.skipped == 4 and len(journal) == 5 and storage['total'] == 30
+
+    # Items that can't be told apart aren't quietly dropped
+    same = [ds.dataset(np.arange(3), x=np.arange(3), cut={'ix': 0}) for i in range(2)]
+    with pytest.raises(ValueError):
+        pipeline.run(same, resume=True)
+    journal.close()
+
+
+def test_journal_restores_changed_objects(tmp_path):
+    for resume in (False, True):
+        # A new storage, as after a crash, with the tracker changed in place and the same peaks every time
+        storage = {'tracker': Tracker()}
+        pipeline = ForEachProcessor([TrackPeaksProcessor], storage)
+        journal = pipeline.set_journal(str(tmp_path / 'tracker.journal'))
+        pipeline.run([0, 1], resume=resume)
+        journal.close()
+    assert journal.skipped == 2
+    assert storage['peak'] == 2 and storage['tracker'].value == 12
+
+
+def _slow_load(path):
+    # The good files take a while, so the bad one has failed before they're used
+    if path == 'bad':
+        raise OSError("Can't read {}".format(path))
+    time.sleep(0.05)
+    return path
+
+
+def test_prefetch_raises_errors_in_order():
+    loaded = []
+    with pytest.raises(OSError):
+        for data in Prefetch(['a', 'b', 'bad', 'c'], _slow_load, ahead=3, max_bytes=10):
+            loaded.append(data)
+    assert loaded == ['a', 'b']
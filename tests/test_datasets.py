@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+
+import datasets as ds
+
+
+@pytest.mark.parametrize('wl', [np.linspace(810, 900, 10), np.linspace(900, 810, 10)])
+def test_sel_range_either_direction(wl):
+    data = ds.dataset(np.arange(10.)[:, None] * np.ones(3), wl=wl, x=np.arange(3))
+    expected = data.raw[4:7] if wl[0] < wl[-1] else data.raw[3:6]
+    for bounds in (slice(850, 870), slice(870, 850)):
+        selected = data.sel(wl=bounds)
+        assert sorted(selected.wl) == [850, 860, 870]
+        np.testing.assert_array_equal(selected.raw, expected)
+    # A missing bound is the start or the end of the axis
+    assert list(data.sel(wl=slice(None, 850)).wl) == list(wl[:list(wl).index(850) + 1])
+    assert list(data.sel(wl=slice(850, None)).wl) == list(wl[list(wl).index(850):])
@@ -0,0 +1,165 @@
+import copy
+import sqlite3
+
+import numpy as np
+import pytest
+
+import datasets as ds
+from dataprocessor import DataProcessor, ForEachProcessor, dag
+from dataprocessor.batch import Batch
+
+lasing = pytest.importorskip('dataprocessor.processors.lasing')
+
+
+def make_data(devices=6, seed=0):
+    # Spectra of devices with a couple of lasing peaks on a broad PL background
+    rng = np.random.default_rng(seed)
+    wl = np.linspace(900, 1000, 400)
+    power = np.linspace(1, 100, 40)
+    background = 200 * np.exp(-((wl - 950) / 40)**2)
+    data = ds.datalist('ix')
+    for ix in range(devices):
+        raw = power[:, None] * background[None] / 50
+        # Peaks in different places on every device, so the PL can be found around them
+        for peak in (120 + 9*ix, 220 + 9*ix):
+            threshold = rng.uniform(20, 60)
+            amplitude = np.where(power > threshold, (power - threshold) * 50, power * 0.5)
+            raw = raw + amplitude[:, None] * np.exp(-((np.arange(400) - peak) / 2.)**2)[None]
+        raw = raw + rng.normal(0, 1, raw.shape)
+        data.append(ds.dataset(raw, power=power, wl=wl), ix)
+    return data
+
+
+@pytest.fixture
+def power_file(tmp_path):
+    path = tmp_path / 'power.csv'
+    percent = np.linspace(0, 100, 11)
+    np.savetxt(path, np.column_stack((percent, 2 * percent + 0.01 * percent**2)), delimiter=',')
+    return str(path)
+
+
+def pl_storage(data, power_file):
+    pls = lasing.PL_Subtractor2()
+    pls.set_pl_from_datalist(data)
+    return {'pls': pls, 'peak_prominence': 100, 'power_file': power_file}
+
+
+def test_documented_dag_example(power_file, tmp_path):
+    lasing_db = pytest.importorskip('dataprocessor.processors.lasing_db')
+    data = make_data(3)
+    results = []
+    for name, stages in (('chain', [lasing.PLSubProcessor, lasing.ConvertPowerProcessor,
+                                    lasing.ThresholdProcessor]),
+                         ('dag', [dag(lasing.PLSubProcessor, lasing.ConvertPowerProcessor,
+                                      lasing.ThresholdProcessor)])):
+        storage = pl_storage(data, power_file)
+        storage['dbname'] = str(tmp_path / (name + '.db'))
+        storage['sp'] = lasing_db.SuperParams("thresholds", lasing_db.param_spec)
+        # The example from the dag docstring, with the database opened and the peaks found first
+        pipeline = DataProcessor([lasing_db.DBProcessor, lasing_db.DBInitProcessor, ForEachProcessor,
+                                  lasing.FindPeaksProcessor] + stages + [lasing_db.SavePeakProcessor], storage)
+        pipeline.run(data)
+        with sqlite3.connect(storage['dbname']) as dbconn:
+            rows = dbconn.execute('SELECT indices, peak_location, fit_indices, '
+                                  'threshold, threshold_error, ll_slope FROM thresholds').fetchall()
+        results.append(rows)
+    chain, graph = results
+    assert len(chain) == 6
+    assert [row[:3] for row in graph] == [row[:3] for row in chain]
+    np.testing.assert_allclose([row[3:] for row in graph], [row[3:] for row in chain], rtol=1e-9)
+
+
+
+def run_serial(cls, datasets, storages):
+    # What run hands on to the next processor for each dataset, as lists of dicts
+    results = []
+    for dataset, storage in zip(datasets, storages):
+        processor = cls([], dict(storage))
+        found = []
+        processor.run_next = lambda d: found.append(copy.deepcopy(
+            {key: processor.storage[key] for key in processor.outputs + processor.mutates}))
+        processor.run(dataset)
+        results.append(found)
+    return results
+
+
+def run_batch(cls, datasets, storages):
+    # The same from run_batch, without the storage of other processors
+    processor = cls([], dict(storages[0]))
+    results = processor.run_batch(Batch(datasets), [dict(storage) for storage in storages])
+    return [[] if result is None else [result] if isinstance(result, dict) else result
+            for result in results]
+
+
+def state(value):
+    # What to compare of a value, like the boundaries of a PL_Subtractor2
+    if isinstance(value, lasing.PL_Subtractor2):
+        return {key: v for key, v in vars(value).items() if np.isscalar(v)}
+    return value
+
+
+def assert_batch_matches(cls, datasets, storages):
+    serial = run_serial(cls, datasets, storages)
+    batch = run_batch(cls, datasets, storages)
+    assert len(batch) == len(serial)
+    for found, expected in zip(batch, serial):
+        assert len(found) == len(expected)
+        for values, expected_values in zip(found, expected):
+            assert sorted(values) == sorted(expected_values)
+            for key in expected_values:
+                value, expected_value = state(values[key]), state(expected_values[key])
+                if isinstance(expected_value, str) or isinstance(expected_value, dict):
+                    assert value == expected_value, key
+                else:
+                    np.testing.assert_allclose(value, expected_value, rtol=1e-9, err_msg=key)
+
+
+def peak_storages(data, power_file):
+    # A storage for every peak, as FindPeaksProcessor leaves them
+    storage = pl_storage(data, power_file)
+    datasets, storages = [], []
+    for dataset, found in zip(data, run_serial(lasing.FindPeaksProcessor, data, [storage] * len(data))):
+        for values in found:
+            datasets.append(dataset)
+            storages.append(dict(storage, **values))
+    return datasets, storages
+
+
+def test_find_peaks_batch(power_file):
+    data = make_data()
+    assert_batch_matches(lasing.FindPeaksProcessor, data, [pl_storage(data, power_file)] * len(data))
+
+
+@pytest.mark.parametrize('name', ['PLSubProcessor', 'DummySubProcessor'])
+def test_subtraction_batch(name, power_file):
+    datasets, storages = peak_storages(make_data(), power_file)
+    assert len(datasets) == 12
+    assert_batch_matches(getattr(lasing, name), datasets, storages)
+
+
+def test_power_batch(power_file):
+    data = make_data()
+    storages = [pl_storage(data, power_file) for dataset in data]
+    assert_batch_matches(lasing.DividePowerProcessor, data, storages)
+    for storage, found in zip(storages, run_serial(lasing.DividePowerProcessor, data, storages)):
+        storage.update(found[0])
+    assert_batch_matches(lasing.ConvertPowerProcessor, data, storages)
+    # Without DividePowerProcessor, the power axis is used
+    assert_batch_matches(lasing.ConvertPowerProcessor, data, [pl_storage(data, power_file)] * len(data))
+
+
+@pytest.mark.parametrize('inflection', [None, 2, 3, 10, 15, 16, 20, 30, 36, 37, 38, 39, 40, 50])
+def test_threshold_batch(inflection):
+    # Light-in light-out curves with thresholds all over, fitted around the same centre
+    rng = np.random.default_rng(1)
+    power = np.linspace(1, 100, 40)
+    data, storages = [], []
+    for threshold in np.linspace(5, 95, 10):
+        dataset = ds.dataset(np.zeros((40, 3)), power=power, wl=np.arange(3.))
+        values = np.where(power > threshold, (power - threshold) * 50, power * 0.5) + rng.normal(0, 5, 40)
+        storage = {'LL_values': list(values), 'power_values': power * 2}
+        if inflection is not None:
+            storage['inflection'] = inflection
+        data.append(dataset)
+        storages.append(storage)
+    assert_batch_matches(lasing.ThresholdProcessor, data, storages)